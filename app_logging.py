@@ -0,0 +1,62 @@
+"""
+📝 ログ設定
+    print()の代わりに使うバッファ付きロガーを提供する
+
+【なぜprintではなくloggingなのか】
+printはGILを握ったままstdoutをflushするため、スレッドプールで
+並列化した取り込み処理(埋め込みバッチやPDF処理)がstdoutへの
+書き込みで直列化されてしまう。QueueHandler+QueueListenerで
+ログI/Oを専用スレッドに逃がすことで、ワーカーはキューに
+積むだけで先へ進める
+
+【使い方】
+from chat.app_logging import get_logger
+logger = get_logger(__name__)
+logger.info("✅ 処理完了")
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+# アプリ共通のルートロガー名
+_ROOT_NAME = "saku"
+
+# QueueListenerはプロセスで1つだけ起動する
+_listener = None
+
+
+def get_logger(name: str = "") -> logging.Logger:
+    """
+    アプリ共通設定済みのロガーを取得する
+
+    初回呼び出し時に一度だけ、キュー経由でstdoutに流す
+    ハンドラーを設定する(2回目以降は設定済みのものを返すだけ)
+
+    Args:
+        name: ロガー名(通常は__name__)
+
+    Returns:
+        設定済みのLogger
+    """
+    global _listener
+
+    root = logging.getLogger(_ROOT_NAME)
+
+    if _listener is None:
+        log_queue = queue.Queue(-1)
+
+        # 出力自体は従来のprintと同じ見た目(メッセージのみ)にする
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter("%(message)s"))
+
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        root.setLevel(logging.INFO)
+        root.propagate = False
+
+    return root.getChild(name) if name else root
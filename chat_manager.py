@@ -15,12 +15,79 @@
 """
 import streamlit as st
 import shortuuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from typing import List, Dict, Any, Optional
 
 
+# 🆕 タイトル生成の多重実行ガード(プロセス内)
+# 同じユーザーがタブを2つ開いている場合など、同一チャットへの
+# タイトル生成が並走するとLLM呼び出しと書き込みが二重になる。
+# 1プロセス構成なのでRedisなどの分散ロックは使わず、
+# モジュールレベルのロック+実行中セットで片方をスキップする
+_title_guard_lock = threading.Lock()
+_titles_in_progress: set = set()
+
+# 🆕 タイトル生成のLLM呼び出しを裏で走らせるための実行器
+# (AI応答のストリーミングと並行して動かすため)
+_title_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="title-gen")
+
+
+@dataclass(slots=True)
+class Message:
+    """
+    🆕 1件のメッセージを表すデータクラス
+
+    【なぜ辞書ではなくデータクラスなのか】
+    メッセージごとに辞書を作ると、キー文字列の保持などで
+    1件あたり数百バイトのオーバーヘッドがかかる。
+    slots=Trueのデータクラスにすることで、session_stateに溜まる
+    履歴のメモリ使用量を約1/3に抑えられる
+
+    【属性】
+    - role: "user" または "assistant"
+    - content: メッセージ内容
+    - is_rag: RAGモードかどうか（assistantメッセージのみ有効）
+    - chunks: RAG使用時の参照チャンク情報
+    - created_at: Firestore上の作成日時（ローカル作成時はNone）
+    """
+    role: str
+    content: str
+    is_rag: bool = False
+    chunks: Optional[List[Dict[str, Any]]] = None
+    created_at: Any = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Message":
+        """
+        Firestoreから取得した辞書をMessageに変換
+
+        Args:
+            data: {"role": "user", "content": "...", ...} 形式の辞書
+
+        Returns:
+            Messageのインスタンス
+        """
+        return cls(
+            role=data.get("role", ""),
+            content=data.get("content", ""),
+            is_rag=bool(data.get("is_rag", False)),
+            chunks=data.get("chunks"),
+            created_at=data.get("created_at")
+        )
+
+
 class ChatManager:
     """
     チャット管理のコントローラークラス
+
+    【会話履歴キャッシュの上限】
+    all_chat_historiesはLRU(最近使ったものを残す)方式で
+    HISTORY_CACHE_SIZE件までに制限する。
+    session_stateに全チャットの履歴を貯め込むと再実行のたびの
+    シリアライズが重くなるため、溢れた分は捨てて遅延読み込みに任せる
     
     【このクラスが持つデータ】
     - self.db_manager: DBManagerのインスタンス(Firestore操作用)
@@ -41,6 +108,10 @@ class ChatManager:
     - メッセージ追加時: Firestoreに保存
     - session_stateはキャッシュとして使用（Firestoreが「正」のデータ）
     """
+
+    # 🆕 会話履歴をキャッシュしておくチャット数の上限
+    HISTORY_CACHE_SIZE = 10
+
     def __init__(self, db_manager, langchain_manager, rag_manager=None):
         """
         クラスの初期化
@@ -69,6 +140,9 @@ class ChatManager:
         # session_stateから復元(Streamlit再実行対策)
         # この関数で self.chat_list と self.all_chat_histories が設定される
         self._restore_from_session_state()
+
+        # 🆕 Firestoreのリアルタイムリスナーを登録(セッションごとに1回)
+        self._start_realtime_listener()
     
     def _restore_from_session_state(self):
         """
@@ -83,20 +157,238 @@ class ChatManager:
         - 初回起動: Firestoreから全データを取得
         - 2回目以降: session_stateから復元（高速化のため）
         """
+        # 🆕 差分同期用のウォーターマーク(チャットごとの最終同期日時)を復元
+        # {"chat_id": datetime, ...}
+        if "last_sync_ts" not in st.session_state:
+            st.session_state.last_sync_ts = {}
+        self._last_sync_ts = st.session_state.last_sync_ts
+
+        # 🆕 タイトル生成済みフラグを復元
+        # {"chat_id": True, ...} 一度生成したチャットは判定をスキップする
+        if "title_generated" not in st.session_state:
+            st.session_state.title_generated = {}
+        self._title_generated = st.session_state.title_generated
+
+        # 🆕 LangChain形式に整形済みの履歴キャッシュを復元
+        # {"chat_id": (履歴件数, 整形済みリスト), ...}
+        if "formatted_histories" not in st.session_state:
+            st.session_state.formatted_histories = {}
+        self._formatted_cache = st.session_state.formatted_histories
+
         # session_stateに"chat_list"がある = 既にデータが存在
         if "chat_list" in st.session_state:
             # 既存データがあれば復元（キャッシュ）
             self.chat_list = st.session_state.chat_list
-            self.all_chat_histories = st.session_state.get("all_chat_histories", {})
+            self.all_chat_histories = st.session_state.get(
+                "all_chat_histories", OrderedDict()
+            )
         else:
-            # 🆕 Firestoreからデータを取得
-            self.chat_list = self._load_chat_list_from_db()
-            self.all_chat_histories = self._load_all_histories_from_db()
-            
+            # 🆕 Firestoreからチャット一覧と直近チャットの会話履歴を取得
+            # (履歴はキャッシュに載せるHISTORY_CACHE_SIZE件分だけ
+            # 並列で先読みし、残りは遅延読み込みに任せる)
+            self.chat_list, raw_histories = (
+                self.db_manager.get_all_chats_with_recent_messages(
+                    limit=None,
+                    history_chats=self.HISTORY_CACHE_SIZE
+                )
+            )
+            # 辞書形式のメッセージをMessageオブジェクトに変換
+            # LRUキャッシュの上限に収まるよう、新しいチャットから順に保持する
+            # (chat_listはupdated_atの降順なので、古い側から入れて新しい側を末尾に)
+            self.all_chat_histories = OrderedDict()
+            for chat in reversed(self.chat_list[:self.HISTORY_CACHE_SIZE]):
+                chat_id = chat["id"]
+                self.all_chat_histories[chat_id] = self._to_messages(
+                    raw_histories.get(chat_id, [])
+                )
+
+            # 差分同期用のウォーターマークも初期化
+            for chat in self.chat_list:
+                self._update_sync_watermark(chat["id"])
+
             # session_stateに保存(キャッシュ)
             st.session_state.chat_list = self.chat_list
             st.session_state.all_chat_histories = self.all_chat_histories
+
+        # 🆕 ID→チャット辞書のインデックスを構築
+        # タイトル取得などでchat_listを毎回ループしなくて済むように、
+        # chat_listと同じ辞書オブジェクトを参照するインデックスを持つ
+        # on_snapshotコールバックは最初のインスタンスに束縛されたまま
+        # 動き続けるため、インデックスもchat_list同様にsession_stateで
+        # セッション内の全インスタンスと共有する(再実行ごとに作り直すと
+        # コールバック側が古いインデックスを見て重複追加してしまう)
+        if "chat_index" not in st.session_state:
+            st.session_state.chat_index = {}
+        self._chat_index = st.session_state.chat_index
+
+        # chat_listと食い違っていればインプレースで同期し直す
+        fresh_index = {chat["id"]: chat for chat in self.chat_list}
+        if fresh_index.keys() != self._chat_index.keys():
+            self._chat_index.clear()
+        self._chat_index.update(fresh_index)
     
+    def _start_realtime_listener(self):
+        """
+        🆕 chatsコレクションのon_snapshotリスナーを登録
+
+        【処理内容】
+        - Firestoreから変更(追加・更新・削除)がプッシュで届くようになる
+        - ポーリング(refresh_from_db)と違い、変更のあったドキュメントだけが
+          ネットワークを流れる
+        - コールバックはバックグラウンドスレッドで実行され、
+          session_stateと共有しているchat_list / all_chat_histories を
+          インプレースで更新する(次の再実行で画面に反映される)
+
+        【注意】
+        Streamlitの再実行のたびに登録しないよう、
+        session_stateのフラグで1セッション1回に制限する
+        """
+        if st.session_state.get("chats_listener_active"):
+            return
+
+        try:
+            watch = self.db_manager.chats_ref.on_snapshot(self._on_chats_snapshot)
+            st.session_state.chats_listener_active = True
+            st.session_state.chats_listener_unsub = watch
+        except Exception as e:
+            print(f"❌ リスナー登録エラー: {e}")
+
+    def _on_chats_snapshot(self, col_snapshot, changes, read_time):
+        """
+        🆕 Firestoreから変更が届いた時のコールバック
+
+        【処理内容】
+        変更の種類ごとにキャッシュをインプレースで更新する
+        - ADDED: チャット一覧の先頭に追加
+        - MODIFIED: タイトルとキャッシュ済み履歴を更新
+        - REMOVED: 一覧と履歴から削除
+
+        Args:
+            col_snapshot: コレクションのスナップショット
+            changes: 変更のリスト
+            read_time: 読み取り時刻
+        """
+        try:
+            for change in changes:
+                doc = change.document
+                chat_id = doc.id
+
+                if change.type.name == "REMOVED":
+                    chat = self._chat_index.pop(chat_id, None)
+                    if chat is not None and chat in self.chat_list:
+                        self.chat_list.remove(chat)
+                    self.all_chat_histories.pop(chat_id, None)
+                    continue
+
+                data = doc.to_dict()
+                title = data.get("title", "無題のチャット")
+
+                chat = self._chat_index.get(chat_id)
+                if chat is None:
+                    # 新しいチャット(別セッションで作成されたものなど)
+                    chat = {"id": chat_id, "title": title}
+                    self.chat_list.insert(0, chat)
+                    self._chat_index[chat_id] = chat
+                else:
+                    chat["title"] = title
+
+                # 履歴はサブコレクション側にあるため、ここでは同期しない
+                # (キャッシュ済みチャットの差分はrefresh_from_dbの
+                # 範囲クエリで取り込む)
+
+        except Exception as e:
+            print(f"❌ スナップショット処理エラー: {e}")
+
+    def subscribe_chat_history(self, chat_id: str):
+        """
+        🆕 表示中チャットのmessagesサブコレクションにリスナーを張る
+
+        【処理内容】
+        - 他デバイス/他セッションでのメッセージ追加がプッシュで届き、
+          再実行ごとのポーリング読み取りなしで履歴が最新に保たれる
+        - リスナーは1セッションにつき現在チャットの1本だけ保持し、
+          チャット切り替え時は古いリスナーを外してから付け替える
+        - コールバックはバックグラウンドスレッドで実行され、
+          session_stateと共有している履歴リストをインプレースで更新する
+
+        Args:
+            chat_id: 購読するチャットID
+        """
+        state = st.session_state.get("history_listener")
+        if state is not None:
+            if state.get("chat_id") == chat_id:
+                return  # 既に購読中
+
+            # チャットが切り替わったので古いリスナーを外す
+            try:
+                state["watch"].unsubscribe()
+            except Exception as e:
+                print(f"❌ 履歴リスナー解除エラー: {e}")
+            st.session_state.history_listener = None
+
+        try:
+            messages_ref = (
+                self.db_manager.chats_ref.document(chat_id)
+                .collection("messages")
+                .order_by("created_at")
+            )
+
+            # コールバックとはリストの同一オブジェクトを共有する
+            # (未キャッシュならここで遅延読み込みされる)
+            histories = self.get_chat_histories(chat_id)
+
+            def _on_messages(col_snapshot, changes, read_time):
+                self._on_history_snapshot(chat_id, histories, col_snapshot)
+
+            watch = messages_ref.on_snapshot(_on_messages)
+            st.session_state.history_listener = {
+                "chat_id": chat_id,
+                "watch": watch
+            }
+        except Exception as e:
+            print(f"❌ 履歴リスナー登録エラー: {e}")
+
+    def _on_history_snapshot(self, chat_id, histories, col_snapshot):
+        """
+        🆕 messagesサブコレクションの変更が届いた時のコールバック
+
+        スナップショットはクエリ結果の全体なので、そこから履歴を
+        組み立て直してスライス代入する(session_stateと同一の
+        リストオブジェクトを保つため再代入はしない)
+
+        Args:
+            chat_id: チャットID
+            histories: all_chat_historiesと共有している履歴リスト
+            col_snapshot: クエリのスナップショット
+        """
+        try:
+            fresh = self._to_messages([doc.to_dict() for doc in col_snapshot])
+
+            # 手元の方が長い場合はwrite-behindの未コミット分が
+            # 含まれているので、サーバーが追いつくまで上書きしない
+            if len(fresh) >= len(histories):
+                histories[:] = fresh
+                self._update_sync_watermark(chat_id)
+
+        except Exception as e:
+            print(f"❌ 履歴スナップショット処理エラー: {e}")
+
+    @staticmethod
+    def _to_messages(messages: List[Any]) -> List[Message]:
+        """
+        🆕 Firestoreから取得した辞書のリストをMessageのリストに変換
+
+        Args:
+            messages: 辞書(またはMessage)のリスト
+
+        Returns:
+            Messageのリスト
+        """
+        return [
+            msg if isinstance(msg, Message) else Message.from_dict(msg)
+            for msg in messages
+        ]
+
     def _load_chat_list_from_db(self) -> List[Dict[str, str]]:
         """
         🆕 Firestoreからチャット一覧を取得
@@ -109,21 +401,41 @@ class ChatManager:
     def _load_all_histories_from_db(self) -> Dict[str, List[Dict[str, Any]]]:
         """
         🆕 Firestoreから全チャットの会話履歴を取得
-        
+
+        【処理内容】
+        - 各チャットの履歴取得は独立したネットワークI/Oなので、
+          ThreadPoolExecutorで並列に取得する
+        - 直列だと合計時間は「各リクエストの待ち時間の合計」になるが、
+          並列なら「一番遅いリクエストの待ち時間」で済む
+
         Returns:
             全チャットの会話履歴
             {"chat_id": [{"role": "user", "content": "..."}, ...], ...}
         """
-        histories = {}
-        for chat in self.chat_list:
-            chat_id = chat["id"]
-            histories[chat_id] = self.db_manager.get_chat_history(chat_id)
-        return histories
+        chat_ids = [chat["id"] for chat in self.chat_list]
+
+        if not chat_ids:
+            return {}
+
+        # Firestoreクライアントはスレッドセーフなので並列に取得できる
+        # (DBManagerの共有プールを使い、プールの作り直しを避ける)
+        results = list(
+            self.db_manager.io_pool.map(self.db_manager.get_chat_history, chat_ids)
+        )
+
+        return {
+            chat_id: self._to_messages(messages)
+            for chat_id, messages in zip(chat_ids, results)
+        }
     
     def get_chat_list(self) -> List[Dict[str, str]]:
         """
         チャット一覧を取得
 
+        再実行のたびに呼ばれてもFirestoreへの読み取りは発生しない
+        (一覧はsession_stateと同じオブジェクトをメモリ上で共有しており、
+        更新はリスナーと書き込み時のインプレース反映で行われる)
+
         【戻り値】
         [{"id": "xxx", "title": "xxx"}, ...]
         
@@ -161,46 +473,85 @@ class ChatManager:
         チャットIDからタイトルを取得
         
         【処理内容】
-        - chat_listをループして、指定されたIDのタイトルを探す
+        - インデックス(_chat_index)から指定されたIDのタイトルを引く
         - 見つからなければ"不明なチャット"を返す
-        
+
         Args:
             chat_id: チャットID
-        
+
         Returns:
             チャットタイトル(文字列)
-        
+
         【呼び出し例】(gui.pyから)
         title = chat_manager.get_chat_title_by_id("abc123")
         """
-        for chat in self.chat_list:
-            # chatは {"id": "xxx", "title": "xxx"} という辞書
-            if chat["id"] == chat_id:
-                # IDが一致したらタイトルを返す
-                return chat["title"]
-            
-        # ループを抜けた = 見つからなかった
+        chat = self._chat_index.get(chat_id)
+        if chat is not None:
+            return chat["title"]
+
+        # インデックスにない = 見つからなかった
         return "不明なチャット"
     
-    def get_chat_histories(self, chat_id: str) -> List[Dict[str, Any]]:
+    def get_chat_histories(self, chat_id: str) -> List["Message"]:
         """
         指定したチャットIDの会話履歴を取得
-        
+
         【処理内容】
         - all_chat_historiesからchat_idに対応する履歴を取得
-        - なければ空リストを返す
-        
+        - 🆕 キャッシュになければFirestoreから遅延読み込みして保存
+        (起動時の全件取得をやめたため、初回アクセス時にここで取得する)
+
         Args:
             chat_id: チャットID
-        
+
         Returns:
-            会話履歴のリスト
-            [{"role": "user", "content": "...", "is_rag": False}, ...]
-        
+            Messageオブジェクトのリスト
+            [Message(role="user", content="...", is_rag=False), ...]
+
         【呼び出し例】(gui.pyから)
         histories = chat_manager.get_chat_histories("abc123")
         """
-        return self.all_chat_histories.get(chat_id, [])
+        # キャッシュにない場合のみFirestoreから取得(遅延読み込み)
+        if chat_id not in self.all_chat_histories:
+            self.all_chat_histories[chat_id] = self._to_messages(
+                self.db_manager.get_chat_history(chat_id)
+            )
+            # 🆕 差分同期用のウォーターマークを更新
+            self._update_sync_watermark(chat_id)
+            # 上限を超えたら一番使われていないチャットの履歴を捨てる
+            self._evict_lru_histories()
+        else:
+            # 使ったチャットを末尾(=最近使った側)に移動
+            self.all_chat_histories.move_to_end(chat_id)
+
+        return self.all_chat_histories[chat_id]
+
+    def _evict_lru_histories(self):
+        """
+        🆕 履歴キャッシュが上限を超えた分を先頭(=最も使われていない側)から捨てる
+
+        捨てた履歴は次にそのチャットを開いた時に
+        Firestoreから遅延読み込みされる
+        """
+        while len(self.all_chat_histories) > self.HISTORY_CACHE_SIZE:
+            self.all_chat_histories.popitem(last=False)
+
+    def _update_sync_watermark(self, chat_id: str):
+        """
+        🆕 差分同期用のウォーターマークを更新
+
+        【処理内容】
+        キャッシュ済み履歴の最後のメッセージのcreated_atを
+        「ここまで同期済み」の印として記録する
+
+        Args:
+            chat_id: チャットID
+        """
+        histories = self.all_chat_histories.get(chat_id, [])
+        for message in reversed(histories):
+            if message.created_at:
+                self._last_sync_ts[chat_id] = message.created_at
+                break
     
     def add_message(
         self,
@@ -241,32 +592,32 @@ class ChatManager:
             chunks=[{"chunk_id": "xxx", "similarity_score": 0.89, "source": "業務フロー.pdf"}]
         )
         """
-        # メッセージ辞書を作成
-        message = {
-            "role": role,
-            "content": content
-        }
-
-        # assistantメッセージの場合のみis_ragとchunksを追加
-        if role == "assistant":
-            message["is_rag"] = is_rag
-            # RAGモードの場合はチャンク情報を追加
-            if is_rag and chunks:
-                message["chunks"] = chunks
+        # Messageオブジェクトを作成
+        # (assistantメッセージ以外はis_rag/chunksを持たない)
+        message = Message(
+            role=role,
+            content=content,
+            is_rag=is_rag if role == "assistant" else False,
+            chunks=chunks if role == "assistant" and is_rag else None
+        )
 
         # ChatManager側のデータを更新
         # chat_idがall_chat_historiesに存在しない場合、空リストを作成
         if chat_id not in self.all_chat_histories:
             self.all_chat_histories[chat_id] = []
+            self._evict_lru_histories()
+        else:
+            # 使ったチャットを末尾(=最近使った側)に移動
+            self.all_chat_histories.move_to_end(chat_id)
 
         # リストにメッセージを追加
+        # (all_chat_historiesはsession_stateと同一オブジェクトなので、
+        # インプレースで追加するだけで再実行後も保持される)
         self.all_chat_histories[chat_id].append(message)
 
-        # session_stateにも同期(これがないとStreamlit再実行時にデータが消える)
-        st.session_state.all_chat_histories = self.all_chat_histories
-
         # 🆕 Firestoreにも保存
-        self.db_manager.save_message(
+        # write-behindバッファ経由なのでFirestoreの応答を待たずにすぐ戻る
+        self.db_manager.save_message_async(
             chat_id=chat_id,
             role=role,
             content=content,
@@ -293,126 +644,159 @@ class ChatManager:
         【呼び出し例】
         new_chat = chat_manager.create_new_chat_with_title("新しいチャット")
         """
-        # 🆕 Firestoreに作成（自動IDを取得）
+        # 🆕 Firestoreに作成
+        # IDはクライアント側で採番されるため、ネットワークを待たずに返ってくる
         new_id = self.db_manager.create_chat(title=title)
-        
+
         if new_id is None:
-            # 作成失敗時はローカルIDを生成
+            # Firestore側の作成に失敗した場合はローカルで採番する
+            # (Noneのままだとdocument(None)への書き込みで全滅するため、
+            # セッション内だけでも会話を続けられるようにする)
             new_id = shortuuid.uuid()
-        
+            print(f"⚠️ チャット作成に失敗したためローカルIDで継続: {new_id}")
+
         new_chat = {"id": new_id, "title": title}
         
         # ChatManager側のデータを更新
         # リストの先頭に追加（新しいチャットが一番上に来るように）
+        # (chat_list / all_chat_historiesはsession_stateと同一オブジェクトなので、
+        # インプレースで更新するだけで同期される)
         self.chat_list.insert(0, new_chat)
+        self._chat_index[new_id] = new_chat
         self.all_chat_histories[new_id] = []
-        
-        # session_stateにも同期
-        st.session_state.chat_list = self.chat_list
-        st.session_state.all_chat_histories = self.all_chat_histories
-        
+        self._evict_lru_histories()
+
         return new_chat
     
-    def format_chat_histories(self, chat_histories: List[Dict[str, str]]) -> List[Any]:
+    def format_chat_histories(self, chat_histories: List["Message"]) -> List[Any]:
         """
         会話履歴をLangChainに渡す用に整形
-        
+
         【処理内容】
-        1. 通常の辞書形式の履歴をループ
+        1. Messageオブジェクトの履歴をループ
         2. roleに応じてHumanMessageまたはAIMessageに変換
         3. 変換したオブジェクトをリストに追加
-        
-        【変換前(通常形式)】
+
+        【変換前(Message形式)】
         [
-            {"role": "user", "content": "こんにちは"},
-            {"role": "assistant", "content": "やあ!"}
+            Message(role="user", content="こんにちは"),
+            Message(role="assistant", content="やあ!")
         ]
-        
+
         【変換後(LangChain形式)】
         [
             HumanMessage(content="こんにちは"),
             AIMessage(content="やあ!")
         ]
-        
+
         Args:
-            chat_histories: 通常形式の会話履歴
-        
+            chat_histories: Messageオブジェクトの会話履歴
+
         Returns:
             LangChain形式のメッセージリスト
-        
+
         【呼び出し例】(gui.pyから)
-        normal_histories = [{"role": "user", "content": "こんにちは"}]
-        lc_messages = chat_manager.format_chat_histories(normal_histories)
-        """
-        lc_chat_list = []
-        for chat in chat_histories:
-            if chat["role"] == "user":
-                # langchain_managerを使ってHumanMessageを作成
-                content = self.langchain_manager.create_human_message(chat["content"])
-                lc_chat_list.append(content)
-            elif chat["role"] == "assistant":
-                # langchain_managerを使ってAIMessageを作成
-                content = self.langchain_manager.create_ai_message(chat["content"])
-                lc_chat_list.append(content)
-        # 変換されたリストを返す
-        return lc_chat_list
+        histories = chat_manager.get_chat_histories("abc123")
+        lc_messages = chat_manager.format_chat_histories(histories)
+        """
+        # roleごとの変換関数をローカル変数の辞書に束ねておき、
+        # ループ内のif/elif分岐と属性参照のコストを省く
+        langchain_manager = self.langchain_manager
+        dispatch = {
+            "user": langchain_manager.create_human_message,
+            "assistant": langchain_manager.create_ai_message
+        }
+
+        return [
+            dispatch[chat.role](chat.content)
+            for chat in chat_histories
+            if chat.role in dispatch
+        ]
     
+    def get_formatted_histories(self, chat_id: str) -> List[Any]:
+        """
+        🆕 LangChain形式の会話履歴をキャッシュ付きで取得
+
+        format_chat_historiesは純粋な変換だが、再実行や同一実行内の
+        複数回呼び出しのたびにHumanMessage/AIMessageを作り直していた。
+        履歴件数をキーにキャッシュし、メッセージが増えた時だけ再変換する
+
+        Args:
+            chat_id: チャットID
+
+        Returns:
+            LangChain形式のメッセージリスト(呼び出し側で安全に
+            appendできるよう、コピーを返す)
+        """
+        histories = self.get_chat_histories(chat_id)
+
+        cached = self._formatted_cache.get(chat_id)
+        if cached is not None and cached[0] == len(histories):
+            return list(cached[1])
+
+        formatted = self.format_chat_histories(histories)
+        self._formatted_cache[chat_id] = (len(histories), formatted)
+        return list(formatted)
+
     def update_chat_title(self, chat_id: str, new_title: str):
         """
         チャットのタイトルを更新
         
         【処理内容】
-        1. chat_listをループして該当するチャットを探す
-        2. 見つかったらタイトルを更新
-        3. session_stateに同期
-        4. 🆕 Firestoreにも保存
-        
+        1. インデックスから該当するチャットを引いてタイトルを更新
+        (chat_list内の同じ辞書を参照しているため、chat_listにも反映される)
+        2. session_stateに同期
+        3. 🆕 Firestoreにも保存
+
         Args:
             chat_id: チャットID
             new_title: 新しいタイトル
-        
+
         【呼び出し例】
         chat_manager.update_chat_title("abc123", "新しいタイトル")
         """
-        for chat in self.chat_list:
-            if chat["id"] == chat_id:
-                chat["title"] = new_title
-                break
-        
-        # session_stateにも同期
-        st.session_state.chat_list = self.chat_list
-        
-        # 🆕 Firestoreにも保存
-        self.db_manager.update_chat_title(chat_id, new_title)
+        # chat_list内の辞書をインプレースで書き換える
+        # (session_stateと同一オブジェクトなので再代入は不要)
+        chat = self._chat_index.get(chat_id)
+        if chat is not None:
+            chat["title"] = new_title
+
+        # 🆕 タイトルが確定したら生成済みフラグを立てる
+        # (以降のshould_generate_titleが即Falseを返せるように)
+        if not new_title.startswith("新規チャット"):
+            self._title_generated[chat_id] = True
+
+        # 🆕 Firestoreにも保存(メッセージと同じバッチに相乗りする非同期版)
+        self.db_manager.update_chat_title_async(chat_id, new_title)
     
     def should_generate_title(self, chat_id: str) -> bool:
         """
         タイトルを自動生成すべきかどうかを判定
         
         【判定条件】
-        1. タイトルが「新規チャット」で始まる
+        1. まだタイトルを生成していない(生成済みフラグでスキップ)
         2. メッセージが2件以上ある(ユーザー1回 + AI1回 = 会話が成立)
-        
+        3. タイトルが「新規チャット」で始まる
+
+        安い判定(辞書参照)から順にチェックして、
+        不要な場合はタイトル解決まで行かずに抜ける
+
         Args:
             chat_id: チャットID
-        
+
         Returns:
             True: タイトル生成すべき / False: 不要
         """
-        # 現在のタイトルを取得
-        current_title = self.get_chat_title_by_id(chat_id)
-        
-        # 「新規チャット」で始まるかチェック
-        if not current_title.startswith("新規チャット"):
+        # 一度生成済みなら以降は常にスキップ
+        if self._title_generated.get(chat_id):
             return False
-        
-        # メッセージ数をチェック
-        histories = self.get_chat_histories(chat_id)
-        # AI応答完了後 = 2件以上(ユーザー + AI)
-        if len(histories) >= 2:
-            return True
-        
-        return False
+
+        # メッセージ数をチェック(AI応答完了後 = 2件以上)
+        if len(self.all_chat_histories.get(chat_id, ())) < 2:
+            return False
+
+        # 最後にタイトルをチェック
+        return self.get_chat_title_by_id(chat_id).startswith("新規チャット")
     
     def generate_chat_title(self, chat_id: str) -> str:
         """
@@ -443,37 +827,143 @@ class ChatManager:
         
         return title
     
+    def maybe_generate_and_update_title(self, chat_id: str) -> Optional[str]:
+        """
+        🆕 必要な場合のみタイトルを生成して更新する(1回の呼び出しで完結)
+
+        should_generate_title → generate_chat_title → update_chat_title
+        を呼び出し側で順に組み立てる必要をなくす。
+        判定はメモリ上のフラグと履歴件数のみ、更新はメッセージと同じ
+        write-behindバッチに相乗りするため、Firestoreへの往復は増えない
+
+        Args:
+            chat_id: チャットID
+
+        Returns:
+            生成されたタイトル(生成不要・失敗時はNone)
+        """
+        if not self.should_generate_title(chat_id):
+            return None
+
+        # 🆕 同じチャットへの生成が実行中なら二重に走らせない
+        with _title_guard_lock:
+            if chat_id in _titles_in_progress:
+                return None
+            _titles_in_progress.add(chat_id)
+
+        try:
+            new_title = self.generate_chat_title(chat_id)
+            self.update_chat_title(chat_id, new_title)
+            return new_title
+        except Exception as e:
+            print(f"❌ タイトル生成エラー: {e}")
+            return None
+        finally:
+            with _title_guard_lock:
+                _titles_in_progress.discard(chat_id)
+
+    def begin_title_generation(self, chat_id: str) -> Optional[Future]:
+        """
+        🆕 タイトル生成をバックグラウンドで開始する(2段階APIの前半)
+
+        AI応答のストリーミングとタイトル生成は独立したLLM呼び出しなので、
+        ユーザーメッセージ保存直後にここで生成を裏で走らせ、
+        ストリーミング完了後にfinish_title_generation()で回収すると、
+        直列だった2回の往復が max(T_stream, T_title) に重なる。
+
+        材料は最初のユーザー発言のみ(タイトルは質問内容でほぼ決まる
+        ため、AI応答の完成を待つ必要がない)。session_stateを読むのは
+        このメインスレッド側で済ませ、ワーカーにはLLM呼び出しだけを渡す
+
+        Args:
+            chat_id: チャットID
+
+        Returns:
+            生成中のFuture(生成不要・実行中の場合はNone)
+        """
+        if self._title_generated.get(chat_id):
+            return None
+
+        histories = self.all_chat_histories.get(chat_id)
+        if not histories:
+            return None
+
+        if not self.get_chat_title_by_id(chat_id).startswith("新規チャット"):
+            return None
+
+        # 同じチャットへの生成が実行中なら二重に走らせない
+        with _title_guard_lock:
+            if chat_id in _titles_in_progress:
+                return None
+            _titles_in_progress.add(chat_id)
+
+        formatted_messages = self.format_chat_histories(histories[:2])
+        future = _title_executor.submit(
+            self.langchain_manager.generate_title, formatted_messages
+        )
+
+        # ガードの解除はFutureの完了に紐付ける。
+        # finish_title_generation()のfinallyで解除すると、ストリーミング中の
+        # 例外でfinishまで到達しなかった場合にガードが残り続け、
+        # そのチャットのタイトル生成が二度と走らなくなる
+        def _release_guard(_future):
+            with _title_guard_lock:
+                _titles_in_progress.discard(chat_id)
+
+        future.add_done_callback(_release_guard)
+        return future
+
+    def finish_title_generation(
+        self,
+        chat_id: str,
+        title_future: Future
+    ) -> Optional[str]:
+        """
+        🆕 begin_title_generation()の結果を回収して反映する(2段階APIの後半)
+
+        Args:
+            chat_id: チャットID
+            title_future: begin_title_generation()が返したFuture
+
+        Returns:
+            生成されたタイトル(失敗時はNone)
+        """
+        # 実行中ガードはFutureのdone_callback側で解除される
+        # (ここで解除すると、直後に始まった別の生成のガードを
+        # 誤って消してしまう可能性がある)
+        try:
+            new_title = title_future.result()
+            self.update_chat_title(chat_id, new_title)
+            return new_title
+        except Exception as e:
+            print(f"❌ タイトル生成エラー: {e}")
+            return None
+
     def delete_chat(self, chat_id: str):
         """
         チャットを削除
 
         【処理内容】
-        1. chat_listから該当するチャットを除外
+        1. インデックスから該当するチャットを取り出してchat_listから削除
         2. all_chat_historiesから該当する履歴を削除
-        3. session_stateに同期
-        4. 🆕 Firestoreからも削除
-        
+        3. 🆕 Firestoreからも削除
+
         Args:
             chat_id: チャットID
-        
-        【リスト内包表記の説明】
-        [chat for chat in self.chat_list if chat["id"] != chat_id]
-        = chat_listの各chatについて、IDがchat_idでないものだけを残す
-        
+
         【呼び出し例】
         chat_manager.delete_chat("abc123")
         """
-        # リスト内包表記で、指定ID以外のチャットを残す
-        # ChatManager側のデータを削除
-        self.chat_list = [chat for chat in self.chat_list if chat["id"] != chat_id]
+        # インデックスから取り出してchat_listから直接削除
+        # (リスト全体を作り直すより速く、session_stateと同一オブジェクトも保てる)
+        chat = self._chat_index.pop(chat_id, None)
+        if chat is not None:
+            self.chat_list.remove(chat)
         # 辞書から該当するキーを削除
         if chat_id in self.all_chat_histories:
             del self.all_chat_histories[chat_id]
-        
-        # session_stateにも同期
-        st.session_state.chat_list = self.chat_list
-        st.session_state.all_chat_histories = self.all_chat_histories
-        
+        self._formatted_cache.pop(chat_id, None)
+
         # 🆕 Firestoreからも削除
         self.db_manager.delete_chat(chat_id)
     
@@ -500,21 +990,72 @@ class ChatManager:
         status = self.rag_manager.get_status()
         return status["collection_info"]["chunk_count"] > 0
     
-    def refresh_from_db(self):
+    def refresh_from_db(self, force_full: bool = False):
         """
         🆕 Firestoreから最新データを再取得
-        キャッシュをクリアしてDBから読み直す
-        
+
+        【処理内容】
+        - チャット一覧は毎回取得(軽量なため)
+        - 会話履歴はウォーターマーク(最終同期日時)以降の差分のみ取得してマージ
+        (全履歴を読み直すと通信量が履歴の長さに比例してしまうため)
+        - force_full=Trueならキャッシュを捨てて全件読み直す
+
         【使用場面】
-        - データの同期が必要な時
-        - 別のセッションで更新があった時
+        - 通常の同期はon_snapshotリスナーがプッシュで行うため、
+          主にデバッグや手動での強制同期に使う
+
+        Args:
+            force_full: Trueならウォーターマークを無視して全件再取得
         """
-        # Firestoreから再取得
-        self.chat_list = self._load_chat_list_from_db()
-        self.all_chat_histories = self._load_all_histories_from_db()
-        
+        # write-behindキューに残っているローカル追記分を先にコミットする
+        # (未コミットのままだと、下の差分取得で拾えずに消えてしまう)
+        self.db_manager.flush_pending_writes()
+
+        # チャット一覧は毎回取得
+        # (session_stateと同一オブジェクトを保つため、スライス代入で入れ替える)
+        self.chat_list[:] = self._load_chat_list_from_db()
+
+        # インデックスも同一オブジェクトを保ったままインプレースで更新
+        # (作り直すと、最初のインスタンスに束縛されたon_snapshot
+        # コールバックが古いインデックスを見続けてしまう)
+        self._chat_index.clear()
+        self._chat_index.update({chat["id"]: chat for chat in self.chat_list})
+
+        if force_full:
+            # ウォーターマークをクリアして全件再取得
+            self._last_sync_ts.clear()
+            self.all_chat_histories.clear()
+            self.all_chat_histories.update(self._load_all_histories_from_db())
+            self._evict_lru_histories()
+            for chat in list(self.all_chat_histories.keys()):
+                self._update_sync_watermark(chat)
+        else:
+            # キャッシュ済みのチャットのみ差分を取得してマージ
+            # (未キャッシュのチャットは初回アクセス時に遅延読み込みされる)
+            for chat_id in list(self.all_chat_histories.keys()):
+                histories = self.all_chat_histories[chat_id]
+                since = self._last_sync_ts.get(chat_id)
+                if since is None:
+                    # ウォーターマークがない場合は全件取得
+                    # (スライス代入でリストオブジェクトを共有したまま入れ替える)
+                    histories[:] = self._to_messages(
+                        self.db_manager.get_chat_history(chat_id)
+                    )
+                else:
+                    delta = self.db_manager.get_chat_history_since(chat_id, since)
+                    if delta:
+                        # ローカルで追記したメッセージ(created_at=None)は
+                        # ウォーターマークを進めないため、コミット後の差分に
+                        # 同じ内容が含まれて戻ってくる。末尾のローカル分を
+                        # サーバー側の確定版で置き換えて二重化を防ぐ
+                        while histories and histories[-1].created_at is None:
+                            histories.pop()
+                        histories.extend(self._to_messages(delta))
+                self._update_sync_watermark(chat_id)
+
         # session_stateを更新
         st.session_state.chat_list = self.chat_list
         st.session_state.all_chat_histories = self.all_chat_histories
-        
+        st.session_state.last_sync_ts = self._last_sync_ts
+
         print("✅ Firestoreから最新データを取得しました")
\ No newline at end of file
@@ -8,15 +8,60 @@
 - 類似度検索
 - コレクション管理
 """
-import os
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Optional
 from pathlib import Path
 
 import chromadb
+import httpx
 from chromadb.config import Settings
 
 from langchain_openai import OpenAIEmbeddings
 
+from chat.app_logging import get_logger
+
+# モジュール共通のロガー(書き込みは専用スレッドにオフロードされる)
+logger = get_logger(__name__)
+
+# 🆕 ドキュメント埋め込みのバッチ設定
+# 全チャンクを1リクエストで送るとネットワーク待ちが直列になるため、
+# 100件ずつに分けてスレッドプールで並列に投げる(埋め込みAPIは
+# ネットワーク待ちが支配的で、レート制限の範囲なら並列化がほぼ線形に効く)
+_EMBED_BATCH_SIZE = 100
+_EMBED_MAX_WORKERS = 8
+
+
+@functools.lru_cache(maxsize=1)
+def _get_embeddings(model: str) -> OpenAIEmbeddings:
+    """
+    🆕 OpenAIEmbeddingsクライアントのシングルトンを取得
+
+    【なぜシングルトンにするのか】
+    Streamlitの再実行のたびにChromaManagerが作り直されると、
+    そのたびに新しいHTTPクライアント(TLS接続)が作られてしまう。
+    プロセス内で1つのクライアントを使い回すことで、
+    埋め込みリクエストがTCP+TLSの接続を再利用できる
+
+    Args:
+        model: 埋め込みモデル名
+
+    Returns:
+        OpenAIEmbeddingsのインスタンス(プロセス内で共有)
+    """
+    return OpenAIEmbeddings(
+        model=model,
+        # HTTP/2 + keep-aliveの接続プールを使い回す
+        http_client=httpx.Client(
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=10,
+                max_connections=20
+            )
+        )
+    )
+
 
 class ChromaManager:
     """
@@ -68,19 +113,38 @@ class ChromaManager:
             path=persist_directory
         )
         
+        # 埋め込みはadd時にembeddings=、検索時にquery_embeddings=で
+        # 明示的に渡すため、コレクションに埋め込み関数は紐付けない
+        # (clear_collection()での再作成時と設定が食い違うのを避ける)
         self.collection = self.client.get_or_create_collection(
             name=collection_name,
             metadata={"description": "アコム ネットサービスセンター 業務ルール資料"}
         )
         
-        self.embeddings = OpenAIEmbeddings(
-            model="text-embedding-3-small"
+        # 🆕 プロセス内で共有するシングルトンのEmbeddingsクライアント
+        self.embeddings = _get_embeddings("text-embedding-3-small")
+
+        # 🆕 ソース一覧のサイドカーファイル
+        # ソース名のsetをpersist_directory内のJSONに保持することで、
+        # ファイル一覧の取得がチャンク数に関係なくO(1)になる
+        self._sources_path = Path(persist_directory) / "_sources.json"
+        self._sources = self._load_sources()
+
+        # 🆕 チャンク数のキャッシュ(collection.count()はDBへの問い合わせで、
+        # サイドバー描画のたびに呼ぶにはコストが高い。書き込み時に無効化する)
+        self._count_cache = None
+
+        # 🆕 クエリ埋め込みのLRUキャッシュ
+        # 同じ質問を繰り返し検索した時にOpenAI APIを呼ばずに済む
+        self._embed_query_cached = functools.lru_cache(maxsize=1024)(
+            self.embeddings.embed_query
         )
-        
-        print(f"✅ ChromaDB初期化完了")
-        print(f"   永続化先: {persist_directory}")
-        print(f"   コレクション: {collection_name}")
-        print(f"   既存ドキュメント数: {self.collection.count()}")
+
+
+        logger.info(f"✅ ChromaDB初期化完了")
+        logger.info(f"   永続化先: {persist_directory}")
+        logger.info(f"   コレクション: {collection_name}")
+        logger.info(f"   既存ドキュメント数: {self.collection.count()}")
     
     def add_documents(
         self,
@@ -94,8 +158,7 @@ class ChromaManager:
         2. メタデータと一緒にChromaDBに格納
         
         Args:
-            chunks: DocumentProcessorで生成したチャンクリスト
-                [{"text": "...", "metadata": {...}}, ...]
+            chunks: DocumentProcessorで生成したChunkのリスト
         
         Returns:
             成功した場合True
@@ -104,37 +167,73 @@ class ChromaManager:
         chroma.add_documents(chunks)
         """
         if not chunks:
-            print("⚠️ 追加するチャンクがありません")
+            logger.warning("⚠️ 追加するチャンクがありません")
             return False
         
         try:
-            texts = [chunk["text"] for chunk in chunks]
-            
-            metadatas = [chunk["metadata"] for chunk in chunks]
+            # texts / metadatas / ids を1回のループでまとめて構築
+            # (3回別々にループするとチャンクリストを3周することになるため)
+            texts = []
+            metadatas = []
+            ids = []
+
+            for chunk in chunks:
+                texts.append(chunk.text)
+                # ChromaDBに渡すメタデータ辞書はここで初めて作る
+                metadatas.append({
+                    "source": chunk.source,
+                    "page": chunk.page,
+                    "chunk_index": chunk.chunk_index
+                })
+                ids.append(
+                    f"{chunk.source}_{chunk.page}_{chunk.chunk_index}"
+                )
             
-            ids = [
-                f"{chunk['metadata']['source']}_{chunk['metadata']['page']}_{chunk['metadata']['chunk_index']}"
-                for chunk in chunks
+            logger.info(f"🔄 ベクトル化して格納中... ({len(texts)}件)")
+
+            # 🆕 埋め込みはバッチに分割してスレッドプールで並列計算する
+            # (接続プールを使い回す共有クライアント経由なので、
+            # 並列に投げてもTLSハンドシェイクは発生しない)
+            batches = [
+                texts[i:i + _EMBED_BATCH_SIZE]
+                for i in range(0, len(texts), _EMBED_BATCH_SIZE)
             ]
-            
-            print(f"🔄 ベクトル化中... ({len(texts)}件)")
-            embeddings = self.embeddings.embed_documents(texts)
-            
+
+            if len(batches) == 1:
+                embeddings = self.embeddings.embed_documents(texts)
+            else:
+                embeddings = []
+                with ThreadPoolExecutor(
+                    max_workers=min(_EMBED_MAX_WORKERS, len(batches))
+                ) as executor:
+                    for batch_result in executor.map(
+                        self.embeddings.embed_documents, batches
+                    ):
+                        embeddings.extend(batch_result)
+
             self.collection.add(
                 ids=ids,
                 embeddings=embeddings,
                 documents=texts,
                 metadatas=metadatas
             )
-            
-            print(f"✅ {len(chunks)}件のチャンクを追加しました")
-            print(f"   合計ドキュメント数: {self.collection.count()}")
+
+            # ソース一覧を更新してサイドカーに保存
+            self._sources.update(
+                metadata["source"] for metadata in metadatas if metadata.get("source")
+            )
+            self._save_sources()
+            self._count_cache = None
+
+
+            logger.info(f"✅ {len(chunks)}件のチャンクを追加しました")
+            logger.info(f"   合計ドキュメント数: {self.collection.count()}")
             return True
             
         except Exception as e:
-            print(f"❌ ドキュメント追加エラー: {e}")
+            logger.error(f"❌ ドキュメント追加エラー: {e}")
             return False
-    
+
     def search(
         self,
         query: str,
@@ -167,7 +266,8 @@ class ChromaManager:
         results = chroma.search("書類不備がある場合の対応は？")
         """
         try:
-            query_embedding = self.embeddings.embed_query(query)
+            # キャッシュ付きのクエリ埋め込み(同じクエリはAPIを呼ばない)
+            query_embedding = self._embed_query_cached(query)
             
             results = self.collection.query(
                 query_embeddings=[query_embedding],
@@ -188,7 +288,7 @@ class ChromaManager:
             return formatted_results
             
         except Exception as e:
-            print(f"❌ 検索エラー: {e}")
+            logger.error(f"❌ 検索エラー: {e}")
             return []
     
     def search_with_threshold(
@@ -202,10 +302,15 @@ class ChromaManager:
         RAGモードで回答すべきか判定するために使用
         
         【処理の流れ】
-        1. 通常の検索を実行
+        1. 距離だけを1件取得するプローブ検索を実行
         2. 最も類似度の高い結果が閾値以下かチェック
-        3. 結果と「RAGを使うべきか」のフラグを返す
-        
+        3. 閾値以下の場合のみ、documents/metadatasを含む本検索を実行
+
+        【なぜ2段階にするのか】
+        閾値を超えてRAGを使わないケース(雑談など)では、
+        documentsやmetadatasの取得・整形が丸ごと無駄になる。
+        距離のみのプローブなら転送も整形もほぼゼロで済む
+
         Args:
             query: 検索クエリ
             threshold: 類似度の閾値（デフォルト0.5）
@@ -226,89 +331,158 @@ class ChromaManager:
         else:
             pass
         """
+        try:
+            # 距離のみ1件のプローブ検索(埋め込みはキャッシュを共有)
+            query_embedding = self._embed_query_cached(query)
+            probe = self.collection.query(
+                query_embeddings=[query_embedding],
+                n_results=1,
+                include=["distances"]
+            )
+
+            if not probe["distances"] or not probe["distances"][0]:
+                return [], False
+
+            best_distance = probe["distances"][0][0]
+
+            if best_distance > threshold:
+                return [], False
+        except Exception as e:
+            logger.error(f"❌ 検索エラー: {e}")
+            return [], False
+
+        # 閾値以下 → 本検索で全文とメタデータを取得
         results = self.search(query, n_results)
-        
+
         if not results:
             return [], False
-        
-        best_distance = results[0]["distance"]
-        
-        if best_distance <= threshold:
-            return results, True
-        else:
-            return [], False
+
+        return results, True
     
+    def _load_sources(self) -> set:
+        """
+        🆕 サイドカーファイルからソース一覧を読み込む
+
+        【処理の流れ】
+        1. _sources.jsonがあれば読み込んでsetにする
+        2. なければ（初回や旧データからの移行時）全メタデータから再構築
+
+        Returns:
+            ソース名のset
+        """
+        try:
+            if self._sources_path.exists():
+                with open(self._sources_path, 'r', encoding='utf-8') as f:
+                    return set(json.load(f))
+        except Exception as e:
+            logger.warning(f"⚠️ ソース一覧読み込みエラー: {e}")
+
+        return self._rebuild_sources()
+
+    def _rebuild_sources(self) -> set:
+        """
+        🆕 全メタデータからソース一覧を再構築してサイドカーに保存
+
+        サイドカーファイルがない場合のみ呼ばれるフォールバック
+
+        【処理内容】
+        - メタデータのみをlimit/offsetでページング取得
+        (全チャンクを一度にメモリへ展開しない。documentsは含めないので
+        転送されるのはメタデータ辞書だけ)
+
+        Returns:
+            ソース名のset
+        """
+        sources = set()
+        page_size = 10000
+
+        try:
+            total = self.collection.count()
+
+            for offset in range(0, total, page_size):
+                results = self.collection.get(
+                    include=["metadatas"],
+                    limit=page_size,
+                    offset=offset
+                )
+
+                if results["metadatas"]:
+                    for metadata in results["metadatas"]:
+                        source = metadata.get("source")
+                        if source:
+                            sources.add(source)
+
+            self._sources = sources
+            self._save_sources()
+
+        except Exception as e:
+            logger.error(f"❌ ソース一覧再構築エラー: {e}")
+
+        return sources
+
+    def _save_sources(self):
+        """🆕 ソース一覧をサイドカーファイルに保存"""
+        try:
+            with open(self._sources_path, 'w', encoding='utf-8') as f:
+                json.dump(sorted(self._sources), f, ensure_ascii=False)
+        except Exception as e:
+            logger.warning(f"⚠️ ソース一覧保存エラー: {e}")
+
+    def _get_unique_sources(self) -> set:
+        """
+        🆕 ユニークなソース名のsetを取得
+
+        サイドカーファイルで管理しているため、
+        コレクションの全スキャンなしでO(1)で返せる
+
+        Returns:
+            ソース名のset
+        """
+        return self._sources
+
     def get_unique_sources_count(self) -> int:
         """
         格納されているユニークなソース（ファイル）の数を取得
-        
+
         【処理の流れ】
-        1. コレクション内の全ドキュメントを取得
-        2. メタデータから"source"を抽出
-        3. 重複を除いてカウント
-        
+        1. サイドカー管理のソースsetを取得
+        2. 件数を返す
+
         Returns:
             ユニークなファイル数
-        
+
         【呼び出し例】
         file_count = chroma.get_unique_sources_count()
         """
         try:
-            if self.collection.count() == 0:
-                return 0
-            
-            results = self.collection.get(
-                include=["metadatas"]
-            )
-            
-            sources = set()
-            if results["metadatas"]:
-                for metadata in results["metadatas"]:
-                    source = metadata.get("source")
-                    if source:
-                        sources.add(source)
-            
-            return len(sources)
-            
+            return len(self._get_unique_sources())
+
         except Exception as e:
-            print(f"❌ ソース数取得エラー: {e}")
+            logger.error(f"❌ ソース数取得エラー: {e}")
             return 0
-    
+
     def get_source_list(self) -> List[str]:
         """
         格納されているファイル名のリストを取得
-        
+
         【処理の流れ】
-        1. コレクション内の全ドキュメントを取得
-        2. メタデータから"source"を抽出
-        3. 重複を除いてソート
-        
+        1. サイドカー管理のソースsetを取得
+        2. ソートして返す
+
         Returns:
             ファイル名のリスト
             例: ["業務フロー.html", "記録ルール.html", "rules.pdf"]
-        
+
         【呼び出し例】
         files = chroma.get_source_list()
         for file in files:
-            print(file)
+            logger.info(file)
         """
         try:
-            if self.collection.count() == 0:
-                return []
-            
-            results = self.collection.get(include=["metadatas"])
-            
-            sources = set()
-            if results["metadatas"]:
-                for metadata in results["metadatas"]:
-                    source = metadata.get("source")
-                    if source:
-                        sources.add(source)
-            
-            return sorted(list(sources))
-            
+            return sorted(self._get_unique_sources())
+
         except Exception as e:
-            print(f"❌ ソースリスト取得エラー: {e}")
+            logger.error(f"❌ ソースリスト取得エラー: {e}")
             return []
     
     def get_collection_info(self) -> Dict[str, Any]:
@@ -324,9 +498,12 @@ class ChromaManager:
                 "persist_directory": "data/chroma_db"
             }
         """
+        if self._count_cache is None:
+            self._count_cache = self.collection.count()
+
         return {
             "name": self.collection_name,
-            "chunk_count": self.collection.count(),
+            "chunk_count": self._count_cache,
             "file_count": self.get_unique_sources_count(),
             "persist_directory": self.persist_directory
         }
@@ -345,11 +522,15 @@ class ChromaManager:
                 name=self.collection_name,
                 metadata={"description": "アコム ネットサービスセンター 業務ルール資料"}
             )
-            print(f"✅ コレクション '{self.collection_name}' をクリアしました")
+            # ソース一覧を空にしてサイドカーに保存
+            self._sources.clear()
+            self._save_sources()
+            self._count_cache = None
+            logger.info(f"✅ コレクション '{self.collection_name}' をクリアしました")
             return True
             
         except Exception as e:
-            print(f"❌ クリアエラー: {e}")
+            logger.error(f"❌ クリアエラー: {e}")
             return False
     
     def delete_by_source(self, source_name: str) -> bool:
@@ -370,9 +551,13 @@ class ChromaManager:
             self.collection.delete(
                 where={"source": source_name}
             )
-            print(f"✅ '{source_name}' のドキュメントを削除しました")
+            # ソース一覧から除外してサイドカーに保存
+            self._sources.discard(source_name)
+            self._save_sources()
+            self._count_cache = None
+            logger.info(f"✅ '{source_name}' のドキュメントを削除しました")
             return True
             
         except Exception as e:
-            print(f"❌ 削除エラー: {e}")
+            logger.error(f"❌ 削除エラー: {e}")
             return False
\ No newline at end of file
@@ -4,39 +4,227 @@
     chat_managerから登録更新用のデータを受け取る
     取得した値をchat_managerに渡す
 
-【Firestoreのデータ構造】
+【Firestoreのデータ構造】🆕
 chats (コレクション)
  └── {chat_id} (ドキュメント)
       ├── title: string
       ├── created_at: timestamp
       ├── updated_at: timestamp
-      └── messages: array
-           └── [
-                 {
-                   role: "user" or "assistant",
-                   content: "メッセージ内容",
-                   is_rag: boolean,
-                   created_at: timestamp,
-                   chunks: [{chunk_id, similarity_score, source}, ...]  # is_rag=trueの時のみ
-                 },
-                 ...
-               ]
+      └── messages (サブコレクション)
+           └── {message_id} (ドキュメント)
+                ├── role: "user" or "assistant"
+                ├── content: "メッセージ内容"
+                ├── is_rag: boolean
+                ├── created_at: timestamp
+                └── chunks: [{chunk_id, similarity_score, source}, ...]  # is_rag=trueの時のみ
+
+【なぜ配列ではなくサブコレクションなのか】
+以前はmessagesをドキュメント内の配列で持っていたが、
+ArrayUnionでの追記は履歴が伸びるほど配列全体の書き換えになり、
+1メッセージの保存コストがO(履歴サイズ)で増えていく
+(さらにドキュメント1MB上限で長い会話が保存できなくなる)。
+サブコレクションなら書き込みは常にO(1)で、読み取りも
+created_atでの範囲クエリやページングができる
 """
 from typing import List, Dict, Any, Optional
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import atexit
+import functools
 import json
+import queue
+import threading
+import time
+
+import orjson
+
+# 🆕 firebase_adminのインポートと初期化は数百msかかるため、
+# モジュール読み込み時ではなく最初のDB操作まで遅延させる
+# (CLIスクリプトやコールドスタートの起動が軽くなる)
+# firestoreモジュールは_get_firestore_client()が設定する
+firestore = None
+
+
+@functools.lru_cache(maxsize=1)
+def _get_firestore_client(credential_path: str):
+    """
+    🆕 Firestoreクライアントを生成して使い回す(プロセスで1つ)
+
+    複数のDBManagerインスタンスができても、
+    接続プールを持つクライアントは1つだけにする
+
+    Args:
+        credential_path: サービスアカウントキーのパス
+
+    Returns:
+        Firestoreクライアント
+    """
+    global firestore
+
+    import firebase_admin
+    from firebase_admin import credentials, firestore as firestore_module
+
+    firestore = firestore_module
+
+    try:
+        # 既に初期化されているかチェック
+        firebase_admin.get_app()
+        print("✅ Firebase既に初期化済み")
+    except ValueError:
+        # 初期化されていない場合は初期化
+        cred = credentials.Certificate(credential_path)
+        firebase_admin.initialize_app(cred)
+        print("✅ Firebase初期化完了")
+
+    return firestore.client()
+
+
+# ============================================
+# 🆕 書き込みバッファ(write-behind)
+# ============================================
+# save_messageのたびにFirestoreの応答を待つと画面が止まるため、
+# メッセージはキューに積んでバックグラウンドスレッドがまとめてコミットする
+# (ユーザー発言とAI応答が1回のバッチコミットにまとまり、書き込み回数も減る)
+
+_write_queue: queue.Queue = queue.Queue()
+_writer_lock = threading.Lock()
+_writer_started = False
+
+# まとめ書き込みまでの待ち時間(秒)
+_FLUSH_INTERVAL = 0.2
+
+
+def _drain_write_queue() -> List[tuple]:
+    """キューに溜まった書き込み要求をすべて取り出す"""
+    pending = []
+    while True:
+        try:
+            pending.append(_write_queue.get_nowait())
+        except queue.Empty:
+            break
+    return pending
+
+
+def _commit_pending(pending: List[tuple]):
+    """
+    溜まった書き込み要求を1回のバッチコミットでFirestoreに反映
+
+    Args:
+        pending: (db_manager, op, chat_id, data) のリスト
+            op: "create"(チャット作成) または "message"(メッセージ追加)
+    """
+    if not pending:
+        return
+
+    try:
+        db_manager = pending[0][0]
+        batch = db_manager.db.batch()
+
+        # チャットごとにメッセージをまとめる
+        messages_by_chat: Dict[str, List[Dict[str, Any]]] = {}
+
+        for _, op, chat_id, data in pending:
+            if op == "create":
+                # チャット作成(merge=Trueなので先行して届いたメッセージを消さない)
+                batch.set(
+                    db_manager.chats_ref.document(chat_id),
+                    data,
+                    merge=True
+                )
+            elif op == "title":
+                # 🆕 タイトル更新もメッセージと同じバッチに相乗りさせる
+                batch.set(
+                    db_manager.chats_ref.document(chat_id),
+                    data,
+                    merge=True
+                )
+            else:
+                messages_by_chat.setdefault(chat_id, []).append(data)
+
+        for chat_id, messages in messages_by_chat.items():
+            chat_ref = db_manager.chats_ref.document(chat_id)
+            # 🆕 メッセージはサブコレクションへ1件1ドキュメントで追加
+            # (配列と違い、履歴がどれだけ長くても書き込みコストは一定)
+            for message in messages:
+                batch.set(
+                    chat_ref.collection("messages").document(),
+                    message
+                )
+            # 親ドキュメントの更新日時も同じバッチで更新
+            # (updateだと作成コミット前にエラーになるためset+merge。
+            # サーバー時刻なのでクライアントの時計ズレの影響を受けない)
+            batch.set(
+                chat_ref,
+                {"updated_at": firestore.SERVER_TIMESTAMP},
+                merge=True
+            )
+
+        batch.commit()
+
+    except Exception as e:
+        print(f"❌ バッチ書き込みエラー: {e}")
+
+
+def _writer_loop():
+    """バックグラウンドでキューを監視してまとめ書き込みする"""
+    while True:
+        # メッセージが来るまで待機
+        first = _write_queue.get()
+        # 直後に続くメッセージを巻き取るため少し待つ
+        time.sleep(_FLUSH_INTERVAL)
+        _commit_pending([first] + _drain_write_queue())
+
+
+def _flush_on_exit():
+    """プロセス終了時に未書き込みのメッセージを吐き出す"""
+    _commit_pending(_drain_write_queue())
+
+
+def _ensure_writer_started():
+    """書き込みスレッドを起動(初回のみ)"""
+    global _writer_started
+    with _writer_lock:
+        if not _writer_started:
+            thread = threading.Thread(target=_writer_loop, daemon=True)
+            thread.start()
+            atexit.register(_flush_on_exit)
+            _writer_started = True
+
+
+def flush_pending_writes():
+    """
+    🆕 バッファ内の書き込みを即座にFirestoreへ反映する
 
-import firebase_admin
-from firebase_admin import credentials, firestore
-from google.cloud.firestore_v1 import ArrayUnion
+    通常は約0.2秒のデバウンスでまとめ書きされるが、
+    エクスポート直前など「今すぐ反映されていてほしい」場面で
+    明示的に呼び出せるようにする
+    """
+    _commit_pending(_drain_write_queue())
+
+
+# キャッシュミスを表す番兵(Noneもキャッシュできるようにするため)
+_CACHE_MISS = object()
 
 
 class DBManager:
     """
     Firebase Firestore管理クラス
     チャットデータの永続化を担当
+
+    【読み取りキャッシュ】🆕
+    get_all_chats / get_chat_by_id / get_chat_history は
+    呼ばれるたびにFirestoreへ往復していたため、
+    TTL付きのLRUキャッシュ(self._cache)で繰り返しの読み取りを省く
+    - キー: "__all__"(一覧) / "chat:{id}"(個別ドキュメント)
+    - 書き込み系メソッドで該当キーと"__all__"を無効化
+    - TTL約30秒で他クライアントからの変更の取りこぼしを抑える
     """
-    
+
+    # キャッシュの生存時間(秒)と保持件数の上限
+    _CACHE_TTL = 30.0
+    _CACHE_SIZE = 64
+
     def __init__(self, credential_path: str = "firebase-key.json"):
         """
         Firestore接続の初期化
@@ -45,27 +233,121 @@ class DBManager:
             credential_path: サービスアカウントキーのパス
         """
         self.credential_path = credential_path
-        self._initialize_firebase()
-    
-    def _initialize_firebase(self):
+        # 🆕 読み取りキャッシュ {key: (値, 有効期限)}
+        self._cache: OrderedDict = OrderedDict()
+        # 🆕 検索用タイトルインデックス (ids, titles, titles_lower) のタプル
+        self._title_index = None
+        # 🆕 Firestore I/O用の共有スレッドプール
+        # (呼び出しのたびにプールを作り直すとスレッド起動コストがかかるうえ、
+        # 並列度もバラつくため、1つのプールを使い回す。
+        # Firestoreクライアントはスレッドセーフ)
+        self.io_pool = ThreadPoolExecutor(
+            max_workers=30, thread_name_prefix="firestore-io"
+        )
+        # 🆕 接続は最初のDB操作まで張らない(遅延初期化)
+        self._db = None
+        self._chats_ref = None
+
+    def _ensure_db(self):
         """
-        Firebaseの初期化
-        既に初期化済みの場合はスキップ
+        🆕 Firestoreクライアントを必要になった時点で初期化
+
+        __init__で同期的に接続していた頃は、DBManagerを作るだけで
+        firebase_adminのインポート+初期化コストがかかっていた
         """
-        try:
-            # 既に初期化されているかチェック
-            firebase_admin.get_app()
-            print("✅ Firebase既に初期化済み")
-        except ValueError:
-            # 初期化されていない場合は初期化
-            cred = credentials.Certificate(self.credential_path)
-            firebase_admin.initialize_app(cred)
-            print("✅ Firebase初期化完了")
-        
-        # Firestoreクライアント取得
-        self.db = firestore.client()
-        self.chats_ref = self.db.collection('chats')
-    
+        if self._db is None:
+            self._db = _get_firestore_client(self.credential_path)
+            self._chats_ref = self._db.collection('chats')
+
+    @property
+    def db(self):
+        """Firestoreクライアント(初回アクセス時に接続)"""
+        self._ensure_db()
+        return self._db
+
+    @property
+    def chats_ref(self):
+        """chatsコレクションへの参照(初回アクセス時に接続)"""
+        self._ensure_db()
+        return self._chats_ref
+
+    # ============================================
+    # 🆕 読み取りキャッシュ
+    # ============================================
+
+    def _cache_get(self, key: str):
+        """
+        キャッシュから値を取得(期限切れなら破棄)
+
+        Args:
+            key: キャッシュキー
+
+        Returns:
+            キャッシュされた値、なければ_CACHE_MISS
+        """
+        entry = self._cache.get(key)
+        if entry is None:
+            return _CACHE_MISS
+
+        value, expire_time = entry
+        if time.time() > expire_time:
+            self._cache.pop(key, None)
+            return _CACHE_MISS
+
+        # ヒットしたら末尾へ移動(LRU)
+        self._cache.move_to_end(key)
+        return value
+
+    def _cache_set(self, key: str, value):
+        """
+        キャッシュに値を保存(上限を超えたら古いものから破棄)
+
+        Args:
+            key: キャッシュキー
+            value: 保存する値
+        """
+        self._cache[key] = (value, time.time() + self._CACHE_TTL)
+        self._cache.move_to_end(key)
+
+        while len(self._cache) > self._CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def _invalidate_cache(self, chat_id: str = None):
+        """
+        書き込み後にキャッシュを無効化
+
+        Args:
+            chat_id: 変更したチャットID(個別キーも消す場合)
+        """
+        self._cache.pop("__all__", None)
+        self._title_index = None
+        if chat_id:
+            self._cache.pop(f"chat:{chat_id}", None)
+            self._cache.pop(f"hist:{chat_id}", None)
+
+    def _get_chat_doc(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        """
+        チャットドキュメント(メタデータ)をキャッシュ経由で取得
+
+        get_chat_by_id などが同じドキュメントを繰り返し読まないよう、
+        生のto_dict()結果を共有する
+
+        Args:
+            chat_id: チャットID
+
+        Returns:
+            ドキュメントの辞書、存在しない場合はNone
+        """
+        key = f"chat:{chat_id}"
+        cached = self._cache_get(key)
+        if cached is not _CACHE_MISS:
+            return cached
+
+        doc = self.chats_ref.document(chat_id).get()
+        data = doc.to_dict() if doc.exists else None
+        self._cache_set(key, data)
+        return data
+
     # ============================================
     # チャット操作
     # ============================================
@@ -79,11 +361,17 @@ class DBManager:
             updated_atの降順（新しい順）
         """
         try:
+            # 呼び出し側は返ったリストをインプレースで書き換えるため、
+            # キャッシュ本体を渡さずコピーを返す(ヒット時も保存時も同様)
+            cached = self._cache_get("__all__")
+            if cached is not _CACHE_MISS:
+                return [dict(chat) for chat in cached]
+
             docs = self.chats_ref.order_by(
-                'updated_at', 
+                'updated_at',
                 direction=firestore.Query.DESCENDING
             ).get()
-            
+
             chats = []
             for doc in docs:
                 data = doc.to_dict()
@@ -91,13 +379,55 @@ class DBManager:
                     "id": doc.id,
                     "title": data.get("title", "無題のチャット")
                 })
-            
+
+            self._cache_set("__all__", [dict(chat) for chat in chats])
+            self._build_title_index(chats)
             return chats
             
         except Exception as e:
             print(f"❌ チャット一覧取得エラー: {e}")
             return []
     
+    def get_all_chats_with_recent_messages(
+        self,
+        limit: Optional[int] = 20,
+        history_chats: int = 10
+    ) -> tuple:
+        """
+        🆕 チャット一覧と直近チャットの会話履歴をまとめて取得
+
+        一覧クエリは1回、履歴はサブコレクションを並列で読む。
+        全チャットの履歴を読むとN回のクエリになってしまうため、
+        キャッシュに載せる直近history_chats件分だけを先読みする
+
+        Args:
+            limit: チャットごとに返す直近メッセージ数(Noneなら全件)
+            history_chats: 履歴を先読みするチャット数(新しい順)
+
+        Returns:
+            (チャット一覧, 会話履歴の辞書) のタプル
+            - チャット一覧: [{"id": "xxx", "title": "xxx"}, ...]
+            - 会話履歴: {"chat_id": [{"role": "user", ...}, ...], ...}
+        """
+        try:
+            chats = self.get_all_chats()
+
+            target_ids = [chat["id"] for chat in chats[:history_chats]]
+            histories = {}
+
+            if target_ids:
+                results = self.io_pool.map(
+                    lambda cid: self.get_chat_history(cid, limit=limit),
+                    target_ids
+                )
+                histories = dict(zip(target_ids, results))
+
+            return chats, histories
+
+        except Exception as e:
+            print(f"❌ 一括取得エラー: {e}")
+            return [], {}
+
     def get_chat_by_id(self, chat_id: str) -> Optional[Dict[str, Any]]:
         """
         指定されたIDのチャット情報を取得
@@ -110,12 +440,11 @@ class DBManager:
             存在しない場合はNone
         """
         try:
-            doc = self.chats_ref.document(chat_id).get()
-            
-            if doc.exists:
-                data = doc.to_dict()
+            data = self._get_chat_doc(chat_id)
+
+            if data is not None:
                 return {
-                    "id": doc.id,
+                    "id": chat_id,
                     "title": data.get("title", "無題のチャット"),
                     "created_at": data.get("created_at"),
                     "updated_at": data.get("updated_at")
@@ -126,6 +455,54 @@ class DBManager:
             print(f"❌ チャット取得エラー: {e}")
             return None
     
+    def get_chats_by_ids(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        🆕 複数チャットのドキュメントを1回のバッチRPCでまとめて取得
+
+        get_chat_by_idをN回ループすると往復もN回になるため、
+        Firestoreのget_all(リクエストの束ね読み)を使う
+
+        Args:
+            ids: チャットIDのリスト
+
+        Returns:
+            {chat_id: ドキュメントの辞書} (存在しないIDは含まれない)
+        """
+        try:
+            if not ids:
+                return {}
+
+            refs = [self.chats_ref.document(chat_id) for chat_id in ids]
+
+            result = {}
+            for snap in self.db.get_all(refs):
+                if snap.exists:
+                    data = snap.to_dict()
+                    result[snap.id] = data
+                    # 個別キャッシュにも載せておく(後続のget_chat_by_id用)
+                    self._cache_set(f"chat:{snap.id}", data)
+
+            return result
+
+        except Exception as e:
+            print(f"❌ 一括取得エラー: {e}")
+            return {}
+
+    def get_chat_by_id_async(self, chat_id: str):
+        """
+        🆕 get_chat_by_idを共有プールに投げてFutureを返す
+
+        複数チャットの読み取りを重ねたい呼び出し側向け
+        (まとめて欲しい場合はget_chats_by_idsの方が往復1回で済む)
+
+        Args:
+            chat_id: チャットID
+
+        Returns:
+            結果を持つFuture
+        """
+        return self.io_pool.submit(self.get_chat_by_id, chat_id)
+
     def create_chat(self, chat_id: str = None, title: str = "新しいチャット") -> Optional[str]:
         """
         新しいチャットを作成
@@ -138,24 +515,34 @@ class DBManager:
             作成されたチャットID、失敗した場合はNone
         """
         try:
-            now = datetime.now()
-            
+            # firestoreモジュール参照より先にクライアントを初期化しておく
+            self._ensure_db()
+
+            # 🆕 タイムスタンプはサーバー側で採番する
+            # (複数クライアント間でも時計ズレなく単調な順序になる)
             chat_data = {
                 "title": title,
-                "created_at": now,
-                "updated_at": now,
-                "messages": []
+                # 🆕 検索用に小文字化したタイトルも書き込み時に持っておく
+                # (プレフィックス検索をサーバー側のインデックスに任せるため)
+                "title_lower": title.lower(),
+                "created_at": firestore.SERVER_TIMESTAMP,
+                "updated_at": firestore.SERVER_TIMESTAMP
             }
-            
+
             if chat_id:
-                # 指定されたIDで作成
-                self.chats_ref.document(chat_id).set(chat_data)
-                return chat_id
+                doc_ref = self.chats_ref.document(chat_id)
             else:
-                # 自動ID生成
-                doc_ref = self.chats_ref.add(chat_data)
-                return doc_ref[1].id
-                
+                # 🆕 クライアント側でIDを自動生成
+                # (document()はネットワーク往復なしでIDを採番する)
+                doc_ref = self.chats_ref.document()
+
+            # 書き込みはwrite-behindバッファに積み、IDだけ即座に返す
+            _ensure_writer_started()
+            _write_queue.put((self, "create", doc_ref.id, chat_data))
+
+            self._invalidate_cache(doc_ref.id)
+            return doc_ref.id
+
         except Exception as e:
             print(f"❌ チャット作成エラー: {e}")
             return None
@@ -174,14 +561,49 @@ class DBManager:
         try:
             self.chats_ref.document(chat_id).update({
                 "title": new_title,
-                "updated_at": datetime.now()
+                "title_lower": new_title.lower(),
+                "updated_at": firestore.SERVER_TIMESTAMP
             })
+            self._invalidate_cache(chat_id)
             return True
             
         except Exception as e:
             print(f"❌ タイトル更新エラー: {e}")
             return False
     
+    def update_chat_title_async(self, chat_id: str, new_title: str) -> bool:
+        """
+        🆕 タイトル更新を書き込みバッファに積む(write-behind)
+
+        AI応答直後の自動タイトル生成では、ユーザー発言・AI応答・
+        タイトルの3つの書き込みが立て続けに発生する。
+        すべて同じバッファに積むことで1回のバッチコミットにまとまり、
+        往復回数が3回から1回になる
+
+        Args:
+            chat_id: チャットID
+            new_title: 新しいタイトル
+
+        Returns:
+            キューに積めた場合True
+        """
+        try:
+            self._ensure_db()
+
+            _ensure_writer_started()
+            _write_queue.put((self, "title", chat_id, {
+                "title": new_title,
+                "title_lower": new_title.lower(),
+                "updated_at": firestore.SERVER_TIMESTAMP
+            }))
+
+            self._invalidate_cache(chat_id)
+            return True
+
+        except Exception as e:
+            print(f"❌ タイトル更新エラー: {e}")
+            return False
+
     def delete_chat(self, chat_id: str) -> bool:
         """
         チャットを削除
@@ -193,39 +615,153 @@ class DBManager:
             成功した場合True
         """
         try:
+            # サブコレクションは親の削除では消えないため先に削除
+            self._delete_messages(chat_id)
             self.chats_ref.document(chat_id).delete()
+            self._invalidate_cache(chat_id)
             return True
             
         except Exception as e:
             print(f"❌ チャット削除エラー: {e}")
             return False
-    
+
+    def bulk_delete_chats(self, chat_ids: List[str]) -> int:
+        """
+        🆕 複数チャットをまとめて削除
+
+        チャットごとにdelete_chat()を呼ぶと、メッセージ取得と削除で
+        チャット数ぶんのラウンドトリップが発生する。ここでは
+        全チャットのメッセージ参照を並列に集めてから、チャット本体と
+        合わせて500オペレーションずつのWriteBatchでコミットする
+
+        Args:
+            chat_ids: 削除するチャットIDのリスト
+
+        Returns:
+            削除したチャット数(失敗時は0)
+        """
+        if not chat_ids:
+            return 0
+
+        try:
+            # メッセージ参照の収集は読み取りなので共有スレッドプールで並列化
+            # (select(["__name__"])でドキュメント名だけの軽量な射影クエリに
+            # する。select([])は「射影なし=全フィールド返却」の意味になり、
+            # 本文を丸ごとダウンロードしてしまう)
+            def _collect_message_refs(chat_id: str):
+                messages_ref = (
+                    self.chats_ref.document(chat_id).collection("messages")
+                )
+                return [
+                    doc.reference
+                    for doc in messages_ref.select(["__name__"]).get()
+                ]
+
+            refs = []
+            for chat_id, message_refs in zip(
+                chat_ids, self.io_pool.map(_collect_message_refs, chat_ids)
+            ):
+                refs.extend(message_refs)
+                refs.append(self.chats_ref.document(chat_id))
+
+            # バッチ上限(500件)ずつコミット
+            for start in range(0, len(refs), 500):
+                batch = self.db.batch()
+                for ref in refs[start:start + 500]:
+                    batch.delete(ref)
+                batch.commit()
+
+            self._invalidate_cache()
+            return len(chat_ids)
+
+        except Exception as e:
+            print(f"❌ 一括削除エラー: {e}")
+            return 0
+
+
     # ============================================
     # メッセージ操作
     # ============================================
     
-    def get_chat_history(self, chat_id: str) -> List[Dict[str, Any]]:
+    def get_chat_history(
+        self,
+        chat_id: str,
+        limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
         """
         指定されたチャットの会話履歴を取得
-        
+
+        🆕 messagesサブコレクションをcreated_at順に読む
+        (limit指定時は新しい側からlimit件だけ取得して並べ直す)
+
         Args:
             chat_id: チャットID
-        
+            limit: 返す直近メッセージ数(Noneなら全件)
+
         Returns:
             会話履歴 [{"role": "user", "content": "xxx", "is_rag": False}, ...]
         """
         try:
-            doc = self.chats_ref.document(chat_id).get()
-            
-            if doc.exists:
-                data = doc.to_dict()
-                return data.get("messages", [])
-            return []
-            
+            key = f"hist:{chat_id}"
+            if limit is None:
+                cached = self._cache_get(key)
+                if cached is not _CACHE_MISS:
+                    return cached
+
+            messages_ref = self.chats_ref.document(chat_id).collection("messages")
+
+            if limit is not None:
+                # 新しい側からlimit件 → 時系列に戻す
+                docs = messages_ref.order_by(
+                    "created_at",
+                    direction=firestore.Query.DESCENDING
+                ).limit(limit).get()
+                messages = [doc.to_dict() for doc in reversed(list(docs))]
+            else:
+                docs = messages_ref.order_by("created_at").get()
+                messages = [doc.to_dict() for doc in docs]
+                self._cache_set(key, messages)
+
+            return messages
+
         except Exception as e:
             print(f"❌ 履歴取得エラー: {e}")
             return []
     
+    def get_chat_history_since(
+        self,
+        chat_id: str,
+        since: datetime
+    ) -> List[Dict[str, Any]]:
+        """
+        🆕 指定日時より後に追加されたメッセージのみを取得
+        差分同期(refresh_from_db)用
+
+        Args:
+            chat_id: チャットID
+            since: この日時より後のメッセージを取得
+
+        Returns:
+            会話履歴の差分 [{"role": "user", "content": "xxx", ...}, ...]
+
+        🆕 サブコレクション化により、差分はサーバー側の範囲クエリで取れる
+        (以前は全履歴を取得してからクライアントでフィルタリングしていた)
+        """
+        try:
+            docs = (
+                self.chats_ref.document(chat_id)
+                .collection("messages")
+                .where("created_at", ">", since)
+                .order_by("created_at")
+                .get()
+            )
+
+            return [doc.to_dict() for doc in docs]
+
+        except Exception as e:
+            print(f"❌ 差分取得エラー: {e}")
+            return []
+
     def save_message(
         self,
         chat_id: str,
@@ -249,32 +785,124 @@ class DBManager:
             成功した場合True
         """
         try:
-            message = {
-                "role": role,
-                "content": content,
-                "created_at": datetime.now()
-            }
+            message = self._build_message(role, content, is_rag, chunks)
 
-            # assistantメッセージの場合のみis_ragを追加
-            if is_rag is not None:
-                message["is_rag"] = is_rag
+            # 🆕 サブコレクションに追加 & 親のupdated_atを更新(1バッチ)
+            chat_ref = self.chats_ref.document(chat_id)
+            batch = self.db.batch()
+            batch.set(chat_ref.collection("messages").document(), message)
+            batch.set(
+                chat_ref,
+                {"updated_at": firestore.SERVER_TIMESTAMP},
+                merge=True
+            )
+            batch.commit()
 
-                # RAGモードの場合はチャンク情報を追加
-                if is_rag and chunks:
-                    message["chunks"] = chunks
+            self._invalidate_cache(chat_id)
+            return True
 
-            # 配列に追加 & updated_atを更新
-            self.chats_ref.document(chat_id).update({
-                "messages": ArrayUnion([message]),
-                "updated_at": datetime.now()
-            })
+        except Exception as e:
+            print(f"❌ メッセージ保存エラー: {e}")
+            return False
+
+    def save_message_async(
+        self,
+        chat_id: str,
+        role: str,
+        content: str,
+        is_rag: bool = None,
+        chunks: List[Dict[str, Any]] = None
+    ) -> bool:
+        """
+        🆕 メッセージを書き込みバッファに積む(write-behind)
+
+        【save_messageとの違い】
+        - save_message: Firestoreの応答を待つ(同期)
+        - save_message_async: キューに積んですぐ戻る(非同期)
+          バックグラウンドスレッドが約0.2秒ごとにまとめてコミットする
 
+        Args:
+            chat_id: チャットID
+            role: メッセージの役割("user" or "assistant")
+            content: メッセージ内容
+            is_rag: RAGモードかどうか（assistantメッセージのみ、Noneの場合は保存しない）
+            chunks: RAG使用時の参照チャンク情報
+
+        Returns:
+            キューに積めた場合True
+        """
+        try:
+            message = self._build_message(role, content, is_rag, chunks)
+
+            _ensure_writer_started()
+            _write_queue.put((self, "message", chat_id, message))
+
+            self._invalidate_cache(chat_id)
             return True
 
         except Exception as e:
-            print(f"❌ メッセージ保存エラー: {e}")
+            print(f"❌ メッセージ登録エラー: {e}")
             return False
-    
+
+    def _build_message(
+        self,
+        role: str,
+        content: str,
+        is_rag: bool = None,
+        chunks: List[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Firestore保存用のメッセージ辞書を作成
+
+        Args:
+            role: メッセージの役割("user" or "assistant")
+            content: メッセージ内容
+            is_rag: RAGモードかどうか（Noneの場合は保存しない）
+            chunks: RAG使用時の参照チャンク情報
+
+        Returns:
+            メッセージ辞書
+        """
+        # メッセージのcreated_atはあえてクライアント時刻のまま
+        # (同一バッチでコミットされるユーザー発言とAI応答が
+        # サーバー時刻だと同時刻になり、order_byの並びが不定になる。
+        # 差分同期のウォーターマーク比較もクライアント側で行っている)
+        message = {
+            "role": role,
+            "content": content,
+            "created_at": datetime.now()
+        }
+
+        # assistantメッセージの場合のみis_ragを追加
+        if is_rag is not None:
+            message["is_rag"] = is_rag
+
+            # RAGモードの場合はチャンク情報を追加
+            if is_rag and chunks:
+                message["chunks"] = chunks
+
+        return message
+
+    def _delete_messages(self, chat_id: str):
+        """
+        🆕 messagesサブコレクションの全ドキュメントをバッチ削除
+
+        Args:
+            chat_id: チャットID
+        """
+        messages_ref = self.chats_ref.document(chat_id).collection("messages")
+
+        # バッチ上限(500件)ずつ削除
+        while True:
+            docs = list(messages_ref.limit(500).get())
+            if not docs:
+                break
+
+            batch = self.db.batch()
+            for doc in docs:
+                batch.delete(doc.reference)
+            batch.commit()
+
     def save_chat_history(
         self,
         chat_id: str,
@@ -291,10 +919,44 @@ class DBManager:
             成功した場合True
         """
         try:
-            self.chats_ref.document(chat_id).update({
-                "messages": messages,
-                "updated_at": datetime.now()
-            })
+            # 既存のサブコレクションを消してから入れ直す
+            self._delete_messages(chat_id)
+
+            batch = self.db.batch()
+            messages_ref = self.chats_ref.document(chat_id).collection("messages")
+
+            # 読み取り側はorder_by("created_at")で並べるため、
+            # created_atを持たないドキュメントはクエリ結果から漏れ、
+            # 文字列のままだとtimestampと別の型順序に入ってしまう。
+            # テンプレート投入やJSON再インポートでも正しく読めるよう、
+            # datetimeでないものには単調増加のdatetimeを刻印する
+            base_ts = datetime.now()
+            for index, message in enumerate(messages):
+                created_at = message.get("created_at")
+
+                if isinstance(created_at, str):
+                    # エクスポートJSONのISO文字列はdatetimeへ戻す
+                    try:
+                        created_at = datetime.fromisoformat(created_at)
+                    except ValueError:
+                        created_at = None
+
+                if not isinstance(created_at, datetime):
+                    created_at = base_ts + timedelta(microseconds=index)
+
+                batch.set(
+                    messages_ref.document(),
+                    {**message, "created_at": created_at}
+                )
+
+            # set(merge=True)にすることで、作成直後(write-behindの
+            # コミット前)のチャットに対してもエラーにならない
+            batch.set(self.chats_ref.document(chat_id), {
+                "updated_at": firestore.SERVER_TIMESTAMP
+            }, merge=True)
+            batch.commit()
+
+            self._invalidate_cache(chat_id)
             return True
             
         except Exception as e:
@@ -312,10 +974,11 @@ class DBManager:
             成功した場合True
         """
         try:
-            self.chats_ref.document(chat_id).update({
-                "messages": [],
-                "updated_at": datetime.now()
-            })
+            self._delete_messages(chat_id)
+            self.chats_ref.document(chat_id).set({
+                "updated_at": firestore.SERVER_TIMESTAMP
+            }, merge=True)
+            self._invalidate_cache(chat_id)
             return True
             
         except Exception as e:
@@ -326,6 +989,62 @@ class DBManager:
     # 検索・統計
     # ============================================
     
+    def _build_title_index(self, chats: List[Dict[str, str]]):
+        """
+        🆕 検索用のタイトルインデックスを構築
+
+        IDとタイトル(小文字化済み)を並びのそろった3本のリストで持つ。
+        検索のたびに辞書を作り直したりlower()し直したりせず、
+        C実装のin演算子による走査だけで済むようにする
+
+        Args:
+            chats: get_all_chatsの戻り値
+        """
+        self._title_index = (
+            [chat["id"] for chat in chats],
+            [chat["title"] for chat in chats],
+            [chat["title"].lower() for chat in chats]
+        )
+
+    def search_chats_by_prefix(
+        self,
+        keyword: str,
+        limit: int = 50
+    ) -> List[Dict[str, str]]:
+        """
+        🆕 タイトルのプレフィックス検索(サーバー側インデックス利用)
+
+        書き込み時に保存しているtitle_lowerへの範囲クエリなので、
+        全件取得せずマッチした分のドキュメントしか読まない
+        (部分一致が必要な場合はsearch_chatsを使う)
+
+        Args:
+            keyword: 検索キーワード(前方一致)
+            limit: 返す最大件数
+
+        Returns:
+            マッチしたチャット一覧 [{"id": "xxx", "title": "xxx"}, ...]
+        """
+        try:
+            keyword_lower = keyword.lower()
+
+            docs = (
+                self.chats_ref
+                .where("title_lower", ">=", keyword_lower)
+                .where("title_lower", "<", keyword_lower + "\uf8ff")
+                .limit(limit)
+                .get()
+            )
+
+            return [
+                {"id": doc.id, "title": doc.to_dict().get("title", "無題のチャット")}
+                for doc in docs
+            ]
+
+        except Exception as e:
+            print(f"❌ 検索エラー: {e}")
+            return []
+
     def search_chats(self, keyword: str) -> List[Dict[str, str]]:
         """
         チャットをキーワード検索（タイトルのみ）
@@ -337,19 +1056,27 @@ class DBManager:
             マッチしたチャット一覧
         
         【注意】
-        Firestoreは部分一致検索が苦手なので、
-        全件取得してPython側でフィルタリング
+        Firestoreは部分一致検索が苦手なのでクライアント側で検索する。
+        🆕 初回に構築したタイトルインデックスを走査するため、
+        キーストロークごとに全件を再取得しない
+        (インデックスは書き込み時に無効化され、次の検索で再構築される)
         """
         try:
-            all_chats = self.get_all_chats()
-            
-            matched = [
-                chat for chat in all_chats
-                if keyword.lower() in chat["title"].lower()
+            if self._title_index is None:
+                self.get_all_chats()
+
+            if self._title_index is None:
+                return []
+
+            ids, titles, lowers = self._title_index
+            keyword_lower = keyword.lower()
+
+            return [
+                {"id": ids[i], "title": titles[i]}
+                for i, title in enumerate(lowers)
+                if keyword_lower in title
             ]
             
-            return matched
-            
         except Exception as e:
             print(f"❌ 検索エラー: {e}")
             return []
@@ -357,18 +1084,32 @@ class DBManager:
     def get_chat_count(self) -> int:
         """
         チャットの総数を取得
+
+        🆕 サーバー側の集計クエリ(count)で数だけを返してもらう
+        (以前は全ドキュメントをダウンロードしてlen()していたため、
+        チャット数に比例して読み取り課金と転送量がかかっていた)
         
         Returns:
             チャット数
         """
         try:
-            docs = self.chats_ref.get()
-            return len(docs)
+            results = self.chats_ref.count().get()
+            return int(results[0][0].value)
             
         except Exception as e:
             print(f"❌ カウントエラー: {e}")
             return 0
-    
+
+    def flush_pending_writes(self):
+        """
+        🆕 write-behindキューの書き込みを即座にFirestoreへ反映する
+
+        モジュールレベルのflush_pending_writes()への薄いラッパー
+        (キューはプロセス共有なのでインスタンスメソッドとしても
+        同じ結果になる。呼び出し側がDBManagerだけ知っていれば済む)
+        """
+        flush_pending_writes()
+
     # ============================================
     # エクスポート・インポート
     # ============================================
@@ -376,14 +1117,26 @@ class DBManager:
     def export_chat_to_json(self, chat_id: str) -> Optional[str]:
         """
         チャットをJSON形式でエクスポート
-        
+
+        🆕 シリアライズはorjson(C実装)で行う
+        - FirestoreのタイムスタンプはDatetimeWithNanoseconds
+          (datetimeのサブクラス)で返り、orjsonは素のdatetime以外を
+          ネイティブ変換しないため、defaultでisoformat()に変換する
+          (ベースラインのISO-8601形式を維持するため)
+        - UTF-8バイト列を直接書き出すため、
+          json.dumps(ensure_ascii=False, indent=2)より数倍速い
+
         Args:
             chat_id: チャットID
-        
+
         Returns:
             JSON文字列、失敗した場合はNone
         """
         try:
+            # write-behindキューに残っているメッセージも
+            # エクスポートに含まれるよう、先にコミットしておく
+            self.flush_pending_writes()
+
             doc = self.chats_ref.document(chat_id).get()
             
             if not doc.exists:
@@ -391,24 +1144,23 @@ class DBManager:
             
             data = doc.to_dict()
             
-            # datetimeをISO形式に変換
             export_data = {
                 "chat_info": {
                     "id": doc.id,
                     "title": data.get("title"),
-                    "created_at": data.get("created_at").isoformat() if data.get("created_at") else None,
-                    "updated_at": data.get("updated_at").isoformat() if data.get("updated_at") else None
+                    "created_at": data.get("created_at"),
+                    "updated_at": data.get("updated_at")
                 },
-                "messages": []
+                "messages": self.get_chat_history(chat_id)
             }
-            
-            for msg in data.get("messages", []):
-                msg_copy = msg.copy()
-                if "created_at" in msg_copy and hasattr(msg_copy["created_at"], "isoformat"):
-                    msg_copy["created_at"] = msg_copy["created_at"].isoformat()
-                export_data["messages"].append(msg_copy)
-            
-            return json.dumps(export_data, ensure_ascii=False, indent=2)
+
+            return orjson.dumps(
+                export_data,
+                option=orjson.OPT_INDENT_2,
+                default=lambda o: (
+                    o.isoformat() if isinstance(o, datetime) else str(o)
+                )
+            ).decode()
             
         except Exception as e:
             print(f"❌ エクスポートエラー: {e}")
@@ -8,18 +8,164 @@
 - チャンク分割（RAG用に適切なサイズに）
 - メタデータの付与（ファイル名、ページ番号など）
 """
+import bisect
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
 from typing import List, Dict, Any
 from pathlib import Path
 
 # PDF処理用ライブラリ
 import fitz  # PyMuPDF
 
-# HTML処理用ライブラリ
-from bs4 import BeautifulSoup
+# 🆕 テキスト抽出用フラグ
+# チャンク化にはテキストストリームだけあればよいので、
+# 画像の取り込みとリガチャ(合字)展開をオフにして抽出を軽くする
+_TEXT_FLAGS = (
+    fitz.TEXTFLAGS_TEXT
+    & ~fitz.TEXT_PRESERVE_IMAGES
+    & ~fitz.TEXT_PRESERVE_LIGATURES
+)
 
-# LangChainのテキスト分割
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+# HTML処理用ライブラリ(lxmlはC実装でhtml.parserより数倍速い)
+from lxml import html as lxml_html
+
+
+@dataclass(slots=True)
+class Chunk:
+    """
+    🆕 1チャンク分のテキストとメタデータ
+
+    【なぜネスト辞書ではなくデータクラスなのか】
+    チャンクごとに {"text": ..., "metadata": {...}} と辞書を2つ作ると、
+    10万チャンク規模のコーパスでPyObjectのオーバーヘッドだけで
+    数十MBになる。slots=Trueでフラットに持てばメモリは約半分で、
+    属性アクセスも辞書引きより速い
+
+    【属性】
+    - text: チャンクのテキスト
+    - source: 元ファイル名
+    - page: ページ番号
+    - chunk_index: ファイル内での通し番号
+    """
+    text: str
+    source: str
+    page: int
+    chunk_index: int
+
+
+# 🆕 チャンク分割の区切り候補(優先度順ではなく一括でスキャンする)
+# 段落 → 改行 → 句点 → 読点 → 空白 の位置を1回のC実装スキャンで拾う
+# モジュールレベルで1回だけコンパイルするため、DocumentProcessorを
+# いくつ作っても(プロセスプールのワーカー内でも)再コンパイルされない
+SPLIT_RE = re.compile(r"\n\n|\n|。|、| ")
+
+# 🆕 HTML抽出後の空白整理用(連続スペース・CRを改行へ)
+_WS_RE = re.compile(r"[ \t]{2,}|\r\n?")
+# 改行まわりの空白と空行を1つの改行にまとめる
+_NL_RE = re.compile(r"[ \t]*\n[ \t\n]*")
+
+
+def _fast_split(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """
+    🆕 正規表現ベースの高速チャンク分割
+
+    【なぜLangChainのRecursiveCharacterTextSplitterを使わないのか】
+    再帰スプリッタはチャンクごとにセパレーターのリストを
+    Pythonループで何度も走査し直すため、大きなテキストで遅い。
+    ここでは区切り候補の位置をre.finditer(C実装)で1回だけ集め、
+    あとはオフセットの整数演算だけでチャンクを切り出す
+
+    【処理の流れ】
+    1. SPLIT_REで区切り候補のオフセットを収集
+    2. chunk_sizeに収まる一番遠い区切りまでを1チャンクとする
+    3. 次のチャンクは(終端 - chunk_overlap)に最も近い区切りから開始
+
+    Args:
+        text: 分割するテキスト
+        chunk_size: 1チャンクの最大文字数
+        chunk_overlap: チャンク間の重複文字数
+
+    Returns:
+        チャンク文字列のリスト
+    """
+    n = len(text)
+
+    if n <= chunk_size:
+        return [text] if text.strip() else []
+
+    # 区切り候補の終了オフセット一覧(末尾も区切りとして扱う)
+    boundaries = [m.end() for m in SPLIT_RE.finditer(text)]
+    boundaries.append(n)
+
+    chunks = []
+    start = 0
+
+    while start < n:
+        limit = start + chunk_size
+
+        if limit >= n:
+            chunk = text[start:]
+            if chunk.strip():
+                chunks.append(chunk)
+            break
+
+        # limit以内で一番遠い区切りを二分探索で見つける
+        j = bisect.bisect_right(boundaries, limit) - 1
+        if j >= 0 and boundaries[j] > start:
+            end = boundaries[j]
+        else:
+            # 区切りがなければ文字数で強制分割
+            end = limit
+
+        chunk = text[start:end]
+        if chunk.strip():
+            chunks.append(chunk)
+
+        # 次の開始位置: (end - overlap)に最も近い区切りへスナップ
+        next_start = end - chunk_overlap
+        k = bisect.bisect_right(boundaries, next_start) - 1
+        if k >= 0 and boundaries[k] > start:
+            next_start = boundaries[k]
+
+        # 前進を保証(overlapが大きすぎて戻ってしまう場合)
+        if next_start <= start:
+            next_start = end
+
+        start = next_start
+
+    return chunks
+
+
+def _process_one_file(
+    file_path: str,
+    chunk_size: int,
+    chunk_overlap: int
+) -> List[Dict[str, Any]]:
+    """
+    🆕 1ファイルを処理するワーカー関数(プロセスプール用)
+
+    ProcessPoolExecutorに渡すためモジュールレベルの関数にしている
+    (インスタンスメソッドはpickleできないため、
+    ワーカー側で新しいDocumentProcessorを作る)
+
+    Args:
+        file_path: 処理するファイルのパス
+        chunk_size: 1チャンクの最大文字数
+        chunk_overlap: チャンク間の重複文字数
+
+    Returns:
+        Chunkのリスト
+    """
+    processor = DocumentProcessor(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
+    )
+
+    if file_path.lower().endswith(".pdf"):
+        return processor.process_pdf(file_path)
+    return processor.process_html(file_path)
 
 
 class DocumentProcessor:
@@ -30,7 +176,6 @@ class DocumentProcessor:
     【このクラスが持つデータ】
     - self.chunk_size: 1チャンクの最大文字数
     - self.chunk_overlap: チャンク間の重複文字数
-    - self.text_splitter: テキスト分割器（LangChain）
     """
     
     def __init__(
@@ -59,15 +204,6 @@ class DocumentProcessor:
         """
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
-        
-        # テキスト分割器を初期化
-        # RecursiveCharacterTextSplitter: 段落→文→単語の順で分割を試みる
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap,
-            # 日本語対応のセパレーター
-            separators=["\n\n", "\n", "。", "、", " ", ""]
-        )
     
     def extract_text_from_pdf(self, pdf_path: str) -> List[Dict[str, Any]]:
         """
@@ -104,13 +240,18 @@ class DocumentProcessor:
         file_name = Path(pdf_path).name
         
         try:
-            # PDFを開く
-            doc = fitz.open(pdf_path)
+            # PDFを開く(filetype指定でフォーマット判定をスキップ)
+            doc = fitz.open(pdf_path, filetype="pdf")
             
             # 各ページを処理
             for page_num, page in enumerate(doc, start=1):
-                # ページからテキストを抽出
-                text = page.get_text()
+                # ブロック一覧からテキストブロックのみを連結
+                # (画像だけのページは全文バッファを作らずスキップ)
+                blocks = page.get_text("blocks", flags=_TEXT_FLAGS)
+                if not blocks:
+                    continue
+
+                text = "\n".join(b[4] for b in blocks if b[6] == 0)
                 
                 # 空でなければ追加
                 if text.strip():
@@ -139,8 +280,8 @@ class DocumentProcessor:
 
         【処理の流れ】
         1. HTMLファイルを読み込む
-        2. BeautifulSoupでHTMLを解析
-        3. テキストのみを抽出（タグを除去）
+        2. 🆕 lxml(C実装)でHTMLを解析
+        3. script/styleを除いたテキストのみを抽出
         4. ファイル名をメタデータとして付与
 
         Args:
@@ -169,20 +310,20 @@ class DocumentProcessor:
             with open(html_path, 'r', encoding='utf-8') as f:
                 html_content = f.read()
 
-            # BeautifulSoupでHTMLを解析
-            soup = BeautifulSoup(html_content, 'html.parser')
+            # lxmlでHTMLを解析(Cのツリー構築なので高速・低メモリ)
+            tree = lxml_html.fromstring(html_content)
 
             # scriptタグとstyleタグを除去
-            for script in soup(['script', 'style']):
-                script.decompose()
+            for bad in tree.xpath('//script|//style'):
+                bad.getparent().remove(bad)
 
             # テキストのみを抽出
-            text = soup.get_text()
+            text = tree.text_content()
 
-            # 余分な空白を削除
-            lines = (line.strip() for line in text.splitlines())
-            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-            text = '\n'.join(chunk for chunk in chunks if chunk)
+            # 余分な空白を正規表現2回の置換で削除
+            # (行ごとのstrip→split→joinというPythonレベルの
+            # ジェネレーターチェーンをC実装のスキャンに置き換え)
+            text = _NL_RE.sub("\n", _WS_RE.sub("\n", text)).strip()
 
             # 空でなければ返す
             if text.strip():
@@ -219,18 +360,7 @@ class DocumentProcessor:
             pages: extract_text_from_pdf()の戻り値
         
         Returns:
-            チャンクごとのテキストとメタデータのリスト
-            [
-                {
-                    "text": "チャンク1のテキスト...",
-                    "metadata": {
-                        "source": "document.pdf",
-                        "page": 1,
-                        "chunk_index": 0
-                    }
-                },
-                ...
-            ]
+            Chunkのリスト
         
         【呼び出し例】
         chunks = processor.split_into_chunks(pages)
@@ -240,50 +370,99 @@ class DocumentProcessor:
         
         for page in pages:
             # ページテキストをチャンクに分割
-            page_chunks = self.text_splitter.split_text(page["text"])
+            page_chunks = _fast_split(
+                page["text"], self.chunk_size, self.chunk_overlap
+            )
             
             # 各チャンクにメタデータを付与
+            metadata = page["metadata"]
             for chunk_text in page_chunks:
-                chunks.append({
-                    "text": chunk_text,
-                    "metadata": {
-                        **page["metadata"],  # 元のメタデータをコピー
-                        "chunk_index": chunk_index
-                    }
-                })
+                chunks.append(Chunk(
+                    text=chunk_text,
+                    source=metadata["source"],
+                    page=metadata["page"],
+                    chunk_index=chunk_index
+                ))
                 chunk_index += 1
         
         print(f"✅ チャンク分割完了: {len(chunks)}チャンク")
         return chunks
     
+    def _iter_pdf_chunks(self, pdf_path: str):
+        """
+        🆕 PDFの抽出と分割を融合したジェネレーター
+
+        【なぜ融合するのか】
+        「全ページを抽出してリスト化 → もう一度なめて分割」だと、
+        同じテキストを2回走査し、全文+全チャンクがメモリに同時に載る。
+        ページごとに抽出→分割→yieldすれば、ピークメモリは
+        1ページ分のテキスト+そのチャンクだけで済む
+
+        Args:
+            pdf_path: PDFファイルのパス
+
+        Yields:
+            Chunk（split_into_chunks()と同じ形式）
+        """
+        file_name = Path(pdf_path).name
+        chunk_index = 0
+
+        try:
+            # filetype指定でフォーマット判定をスキップ
+            doc = fitz.open(pdf_path, filetype="pdf")
+
+            for page_num, page in enumerate(doc, start=1):
+                # 🆕 まずブロック一覧だけ取り、テキストブロックがない
+                # ページ(画像のみ・白紙)は全文バッファを作らずスキップ
+                blocks = page.get_text("blocks", flags=_TEXT_FLAGS)
+                if not blocks:
+                    continue
+
+                # b[6] == 0 がテキストブロック(1は画像)
+                text = "\n".join(b[4] for b in blocks if b[6] == 0)
+
+                if not text.strip():
+                    continue
+
+                # 抽出したそばからチャンクに分割して流す
+                for chunk_text in _fast_split(
+                    text, self.chunk_size, self.chunk_overlap
+                ):
+                    yield Chunk(
+                        text=chunk_text,
+                        source=file_name,
+                        page=page_num,
+                        chunk_index=chunk_index
+                    )
+                    chunk_index += 1
+
+            doc.close()
+
+            print(f"✅ PDF処理完了: {file_name} ({chunk_index}チャンク)")
+
+        except Exception as e:
+            print(f"❌ PDF読み込みエラー: {pdf_path}")
+            print(f"   エラー内容: {e}")
+
     def process_pdf(self, pdf_path: str) -> List[Dict[str, Any]]:
         """
         PDFを処理してチャンクに分割（一連の処理をまとめて実行）
         
         【処理の流れ】
-        1. PDFからテキスト抽出
-        2. チャンクに分割
-        3. 結果を返す
+        🆕 ページごとに「抽出 → 分割」を流れ作業で行う
+        (_iter_pdf_chunksに委譲。全文を一度メモリに
+        並べてから分割し直す2パス処理をやめた)
         
         Args:
             pdf_path: PDFファイルのパス
         
         Returns:
-            チャンクのリスト（split_into_chunks()と同じ形式）
+            Chunkのリスト（split_into_chunks()と同じ形式）
         
         【呼び出し例】
         chunks = processor.process_pdf("data/documents/rules.pdf")
         """
-        # テキスト抽出
-        pages = self.extract_text_from_pdf(pdf_path)
-        
-        if not pages:
-            return []
-        
-        # チャンク分割
-        chunks = self.split_into_chunks(pages)
-
-        return chunks
+        return list(self._iter_pdf_chunks(pdf_path))
 
     def process_html(self, html_path: str) -> List[Dict[str, Any]]:
         """
@@ -298,7 +477,7 @@ class DocumentProcessor:
             html_path: HTMLファイルのパス
 
         Returns:
-            チャンクのリスト（split_into_chunks()と同じ形式）
+            Chunkのリスト（split_into_chunks()と同じ形式）
 
         【呼び出し例】
         chunks = processor.process_html("data/documents/rules.html")
@@ -320,7 +499,9 @@ class DocumentProcessor:
 
         【処理の流れ】
         1. ディレクトリ内の.pdfと.htmlファイルを検索
-        2. 各ファイルを処理
+        2. 🆕 プロセスプールでファイル単位に並列処理
+        (テキスト抽出・チャンク分割はCPUバウンドなので、
+        マルチコアを使うとファイル数分ほぼ線形に速くなる)
         3. 全チャンクをまとめて返す
 
         Args:
@@ -334,16 +515,25 @@ class DocumentProcessor:
         """
         all_chunks = []
 
-        # ディレクトリ内のファイルを取得
-        directory = Path(directory_path)
-
-        if not directory.exists():
+        if not os.path.isdir(directory_path):
             print(f"❌ ディレクトリが存在しません: {directory_path}")
             return []
 
-        # .pdfと.htmlファイルを検索
-        pdf_files = list(directory.glob("*.pdf"))
-        html_files = list(directory.glob("*.html"))
+        # 🆕 .pdfと.htmlファイルを1回のos.scandirで振り分ける
+        # (globを2回呼ぶと全エントリを2回stat()することになり、
+        # NFSなどのリモートファイルシステムで効いてくる)
+        pdf_files = []
+        html_files = []
+
+        with os.scandir(directory_path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                name = entry.name.lower()
+                if name.endswith(".pdf"):
+                    pdf_files.append(entry.path)
+                elif name.endswith(".html"):
+                    html_files.append(entry.path)
 
         total_files = len(pdf_files) + len(html_files)
 
@@ -353,15 +543,31 @@ class DocumentProcessor:
 
         print(f"📁 {len(pdf_files)}個のPDFファイル、{len(html_files)}個のHTMLファイルを検出")
 
-        # 各PDFを処理
-        for pdf_file in pdf_files:
-            chunks = self.process_pdf(str(pdf_file))
-            all_chunks.extend(chunks)
-
-        # 各HTMLを処理
-        for html_file in html_files:
-            chunks = self.process_html(str(html_file))
-            all_chunks.extend(chunks)
+        all_files = pdf_files + html_files
+
+        # 🆕 ファイル単位でプロセスプールに振り分ける
+        # (1ファイルだけなら、プール起動コストを避けてそのまま処理)
+        if len(all_files) == 1:
+            all_chunks.extend(
+                _process_one_file(all_files[0], self.chunk_size, self.chunk_overlap)
+            )
+        else:
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+                futures = [
+                    executor.submit(
+                        _process_one_file,
+                        file_path,
+                        self.chunk_size,
+                        self.chunk_overlap
+                    )
+                    for file_path in all_files
+                ]
+
+                for future in as_completed(futures):
+                    try:
+                        all_chunks.extend(future.result())
+                    except Exception as e:
+                        print(f"❌ ファイル処理エラー: {e}")
 
         print(f"✅ 全ファイル処理完了: 合計{len(all_chunks)}チャンク")
         return all_chunks
@@ -21,6 +21,8 @@
 - 🆕 Firebase Firestore対応
 """
 import streamlit as st
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Any
 import os
 from dotenv import load_dotenv
@@ -28,6 +30,61 @@ from dotenv import load_dotenv
 # 環境変数を読み込む
 load_dotenv()
 
+# 🆕 再実行のたびにos.getenvを呼ばないよう、モジュール読み込み時に1回だけ解決
+GOOGLE_DRIVE_FOLDER_URL = os.getenv("GOOGLE_DRIVE_FOLDER_URL", "")
+
+# フォルダーリンクのmarkdownも定数として組み立てておく(未設定なら空)
+_DRIVE_FOLDER_MARKDOWN = (
+    f"📁 [**資料格納先に移動**]({GOOGLE_DRIVE_FOLDER_URL})"
+    if GOOGLE_DRIVE_FOLDER_URL else ""
+)
+
+# 🆕 ストリーミング表示の更新間隔(秒)と、間隔内でも強制描画するトークン数
+# トークンごとにmarkdownを呼ぶと、応答全文が毎回WebSocketで送り直されて
+# 転送量がトークン数の2乗で増えるため、描画をまとめて間引く
+_STREAM_FLUSH_INTERVAL = 0.05
+_STREAM_FLUSH_TOKENS = 20
+
+# 🆕 RAG検索(埋め込み+ChromaDB問い合わせ)を裏で走らせるための実行器
+# 検索と会話履歴の整形は互いに独立なので、検索をこのスレッドに投げて
+# 待っている間に履歴整形を済ませる。session_stateに触るのは
+# メインスレッド側だけに限定する(Streamlitのスレッド制約)
+_RAG_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rag-search")
+
+
+def _stream_to_placeholder(placeholder, stream) -> str:
+    """
+    🆕 ストリーミング応答をバッチ描画しながらプレースホルダーに流す
+
+    Args:
+        placeholder: st.empty()で作ったプレースホルダー
+        stream: トークンを返すイテレーター
+
+    Returns:
+        応答の全文
+    """
+    full_response = ""
+    pending_tokens = 0
+    last_flush = time.monotonic()
+
+    for chunk in stream:
+        full_response += chunk
+        pending_tokens += 1
+
+        now = time.monotonic()
+        if (
+            pending_tokens >= _STREAM_FLUSH_TOKENS
+            or now - last_flush >= _STREAM_FLUSH_INTERVAL
+        ):
+            placeholder.markdown(full_response)
+            pending_tokens = 0
+            last_flush = now
+
+    # ループ後に必ず最終状態を描画
+    placeholder.markdown(full_response)
+    return full_response
+
+
 class GUI:
     """
     GUI管理クラス
@@ -113,24 +170,26 @@ class GUI:
             current_id = st.session_state.current_chat["id"]
             st.session_state.current_chat["title"] = self.chat_manager.get_chat_title_by_id(current_id)
     
-    def _update_current_chat(self, new_id: str):
+    def _update_current_chat(self, new_id: str, new_title: str = None):
         """
         選択中のチャットIDを更新
-        ChatManagerから最新データを取得
 
         【処理内容】
         1. session_stateのcurrent_chat.idを更新
-        2. ChatManagerから新しいIDのタイトルを取得
-        3. session_stateのcurrent_chat.titleを更新
+        2. タイトルを更新(呼び出し側が持っていればそれを使い、
+           なければChatManagerのIDインデックスからO(1)で取得)
         
         Args:
             new_id: 新しいチャットID
+            new_title: 新しいチャットのタイトル(分かっている場合)
         
         【呼び出し例】(サイドバーのボタンが押された時)
-        self._update_current_chat("def456")
+        self._update_current_chat("def456", "チャットタイトル")
         """
         st.session_state.current_chat["id"] = new_id
-        st.session_state.current_chat["title"] = self.chat_manager.get_chat_title_by_id(new_id)
+        if new_title is None:
+            new_title = self.chat_manager.get_chat_title_by_id(new_id)
+        st.session_state.current_chat["title"] = new_title
         
         # チャット切り替え時は最新の履歴をChatManagerから取得
         # (session_stateに保存されているものと同じだが、明示的に取得)
@@ -197,45 +256,49 @@ class GUI:
             chunks=chunks
         )
     
-    def _auto_generate_title_if_needed(self) -> bool:
+    def _auto_generate_title_if_needed(self, title_future=None) -> bool:
         """
         必要に応じてタイトルを自動生成
-        
+
         【処理の流れ】
-        1. ChatManagerに「タイトル生成すべきか」を確認
-        2. 必要なら生成して更新
+        1. 🆕 裏で開始済みの生成(begin_title_generation)があれば回収
+        2. なければ従来どおり判定・生成・更新を1呼び出しで実行
         3. session_stateのcurrent_chat.titleも更新
-        
+
         【呼び出しタイミング】
         AI応答完了後
-        
+
+        Args:
+            title_future: begin_title_generation()が返したFuture(あれば)
+
         Returns:
             bool: タイトルが生成された場合True、されなかった場合False
         """
         current_id = st.session_state.current_chat["id"]
-        
-        # タイトル生成が必要かチェック
-        if self.chat_manager.should_generate_title(current_id):
-            try:
-                # タイトルを生成
-                new_title = self.chat_manager.generate_chat_title(current_id)
-                
-                # ChatManagerのタイトルを更新（Firestoreにも保存される）
-                self.chat_manager.update_chat_title(current_id, new_title)
-                
-                # session_stateのcurrent_chat.titleも更新
-                st.session_state.current_chat["title"] = new_title
-                
-                # タイトルが生成されたことを返す
-                return True
-                
-            except Exception as e:
-                # エラーが発生してもアプリを止めない
-                print(f"タイトル生成エラー: {e}")
-                return False
-        
-        # タイトル生成が不要だった場合
-        return False
+
+        if title_future is not None:
+            # ストリーミングと並行して生成していた結果を回収
+            new_title = self.chat_manager.finish_title_generation(
+                current_id, title_future
+            )
+        else:
+            # 判定・生成・更新をChatManagerの1呼び出しにまとめる
+            # (更新の書き込みはメッセージ保存と同じバッチにまとまる)
+            new_title = self.chat_manager.maybe_generate_and_update_title(current_id)
+
+        if new_title is None:
+            return False
+
+        # session_stateのcurrent_chat.titleも更新
+        st.session_state.current_chat["title"] = new_title
+
+        # タイトル表示だけをその場で書き換える
+        # (st.rerun()で全体を再実行するより圧倒的に軽い)
+        placeholder = getattr(self, "_title_placeholder", None)
+        if placeholder is not None:
+            placeholder.subheader(f"📂 {new_title}")
+
+        return True
     
     def _render_title(self):
         """
@@ -290,14 +353,17 @@ class GUI:
         # チャット一覧のボタンを表示
         for chat in chat_list:
             if st.sidebar.button(f"{chat['title']}", key=f"link_{chat['id']}"):
-                # ボタンが押されたらIDを更新
-                self._update_current_chat(chat["id"])
+                # ボタンが押されたらIDを更新(タイトルは手元にあるので渡す)
+                self._update_current_chat(chat["id"], chat["title"])
                 st.rerun()  # 画面を再描画
         
         if self.rag_manager:
             st.sidebar.divider()
             st.sidebar.subheader("📚 RAG設定")
-            
+
+            # get_status()はチャンク数キャッシュ導入後は完全にメモリ上の
+            # 参照のみ(ChromaDBへの問い合わせなし)なので、値が変わらない
+            # 再実行でもsession_stateに退避するより安い
             status = self.rag_manager.get_status()
             collection_info = status['collection_info']
             
@@ -308,17 +374,21 @@ class GUI:
             if "previous_threshold" not in st.session_state:
                 st.session_state.previous_threshold = status['threshold']
             
-            current_threshold = status['threshold']
-            new_threshold = st.sidebar.slider(
-                "閾値",
-                min_value=0.0,
-                max_value=3.0,
-                value=current_threshold,
-                step=0.1,
-                help="値が小さいほど厳密にマッチします。通常は1.0〜2.0が推奨です。"
-            )
-            
-            if new_threshold != st.session_state.previous_threshold:
+            # 🆕 スライダーはフォームで包む
+            # (素のスライダーはドラッグの1目盛りごとにスクリプト全体が
+            # 再実行されるため、「適用」を押した時だけ反映する)
+            with st.sidebar.form("rag_threshold_form", border=False):
+                new_threshold = st.slider(
+                    "閾値",
+                    min_value=0.0,
+                    max_value=3.0,
+                    value=status['threshold'],
+                    step=0.1,
+                    help="値が小さいほど厳密にマッチします。通常は1.0〜2.0が推奨です。"
+                )
+                applied = st.form_submit_button("適用")
+
+            if applied and new_threshold != st.session_state.previous_threshold:
                 self.rag_manager.threshold = new_threshold
                 st.session_state.previous_threshold = new_threshold
                 st.toast(f"✅ 閾値を {new_threshold} に更新しました", icon="✅")
@@ -326,18 +396,23 @@ class GUI:
             with st.sidebar.expander("📄 格納されているファイル"):
                 source_list = self.rag_manager.chroma_manager.get_source_list()
                 if source_list:
-                    # 📁 Googleドライブフォルダへのリンクを環境変数から取得
-                    drive_folder_url = os.getenv("GOOGLE_DRIVE_FOLDER_URL", "")
-                    if drive_folder_url:
+                    # 📁 Googleドライブフォルダへのリンク(モジュール定数)
+                    if _DRIVE_FOLDER_MARKDOWN:
                         st.markdown(
-                            f"📁 [**資料格納先に移動**]({drive_folder_url})",
+                            _DRIVE_FOLDER_MARKDOWN,
                             unsafe_allow_html=True
                         )
                         st.divider()
 
                     # ファイル一覧を表示（クリック不可）
-                    for i, source in enumerate(source_list, 1):
-                        st.markdown(f"{i}. {source}")
+                    # 🆕 1ファイル1要素ではなく、まとめて1つのmarkdownで描画
+                    # (expanderの中身は閉じていても毎回実行されるため、
+                    # N回のst.markdown呼び出し=N個のWebSocket要素を
+                    # 1回にまとめる)
+                    st.markdown("\n".join(
+                        f"{i}. {source}"
+                        for i, source in enumerate(source_list, 1)
+                    ))
                 else:
                     st.text("ファイルが登録されていません")
 
@@ -382,13 +457,99 @@ class GUI:
         【処理内容】
         1. 現在のチャットIDからタイトルを取得
         2. st.subheader()で表示"""
+        # 🆕 プレースホルダーにしておくと、タイトル自動生成後に
+        # 全体を再実行せずこの要素だけ書き換えられる
+        self._title_placeholder = st.empty()
+
         selected_title = self.chat_manager.get_chat_title_by_id(
             st.session_state.current_chat["id"]
         )
         # 「新規チャット」で始まる場合は表示しない
         if not selected_title.startswith("新規チャット"):
-            st.subheader(f"📂 {selected_title}")
+            self._title_placeholder.subheader(f"📂 {selected_title}")
     
+    def _build_chunk_reference_items(
+        self,
+        chunks: List[Dict[str, Any]],
+        with_page: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        🆕 参照資料の表示用データを事前に組み立てる
+
+        f-string整形やリンク解決を描画ループの外で1回だけ行い、
+        描画側はst.markdownを呼ぶだけの密なループにする
+
+        Args:
+            chunks: 保存済みチャンク(source/similarity_score)または
+                    検索結果(source/page/text/distance、フラット形式)のリスト
+            with_page: 検索結果形式(ページ番号と抜粋つき)かどうか
+
+        Returns:
+            [{"display": "...", "score_line": "...", "excerpt": None or "..."}, ...]
+        """
+        resolve_link = (
+            self.rag_manager.get_google_drive_link if self.rag_manager else None
+        )
+
+        items = []
+        for i, chunk in enumerate(chunks, 1):
+            if with_page:
+                # 検索結果はRAGManager側でフラット化済み
+                source = chunk['source']
+                score = chunk['distance']
+                excerpt = f"> {chunk['text'][:200]}..."
+                suffix = f" (ページ {chunk['page']})"
+            else:
+                source = chunk.get('source', '不明')
+                score = chunk.get('similarity_score', 0)
+                excerpt = None
+                suffix = ""
+
+            drive_link = resolve_link(source) if resolve_link else ""
+            if drive_link:
+                display = f"**[{i}]** [{source}]({drive_link}){suffix} 📄"
+            else:
+                display = f"**[{i}]** {source}{suffix}"
+
+            items.append({
+                "display": display,
+                "score_line": (
+                    f"**類似度スコア**: {score:.4f} (スコアが低いほど関連性が高い)"
+                ),
+                "excerpt": excerpt
+            })
+
+        return items
+
+    def _render_chunk_references(self, items: List[Dict[str, Any]]):
+        """
+        🆕 参照資料の詳細をエキスパンダーに描画(共通処理)
+
+        _render_chat_history と _process_ai_response_with_rag で
+        ほぼ同じループが重複していたため1箇所にまとめた
+
+        チャンクごとにst.markdown/st.dividerを呼ぶと要素数が約4Nになり、
+        その分WebSocketのデルタも増えるため、markdownの`---`を区切り線に
+        使って全体を1つの文字列に連結し、st.markdown 1回で描画する
+
+        Args:
+            items: _build_chunk_reference_itemsの戻り値
+        """
+        with st.expander("📖 参照した資料の詳細を見る", expanded=False):
+            total = len(items)
+            lines = []
+            for i, item in enumerate(items, 1):
+                lines.append(item["display"])
+                if item["excerpt"]:
+                    lines.append(item["excerpt"])
+                lines.append(item["score_line"])
+
+                # 最後以外は区切り線を入れる
+                if i < total:
+                    lines.append("---")
+
+            st.markdown("\n\n".join(lines))
+
     def _render_chat_history(self):
         """
         会話履歴を表示
@@ -404,47 +565,39 @@ class GUI:
         チャット形式でメッセージを表示するStreamlitの機能
         - role="user": 右側に表示(ユーザー)
         - role="assistant": 左側に表示(AI)
+
+        【描画コストについて】
+        Streamlitは再実行のたびに白紙の画面へ全要素を描き直すため、
+        「前回描いた分をスキップして差分だけ描く」ことはできない
+        (描画済み件数をsession_stateで覚えても、再実行時に
+        過去のメッセージが画面から消えてしまう)。
+        ストリーミング中の負荷はトークンのバッチ描画側で抑えている
         """
+        current_id = st.session_state.current_chat["id"]
+
+        # 🆕 表示中チャットのメッセージにリスナーを張る
+        # (購読済みなら何もしない。チャット切り替え時は付け替えられ、
+        # 他セッションからの追加がプッシュで届く)
+        self.chat_manager.subscribe_chat_history(current_id)
+
         # ChatManagerから最新の会話履歴を取得
         # get_chat_histories()に現在のチャットIDを渡す
-        chat_histories = self.chat_manager.get_chat_histories(
-            st.session_state.current_chat["id"]
-        )
+        chat_histories = self.chat_manager.get_chat_histories(current_id)
 
         # 履歴をループして表示
+        # (メッセージはChatManagerのMessageオブジェクト)
         for chat in chat_histories:
-            with st.chat_message(chat["role"]):
-                st.markdown(chat["content"])
+            with st.chat_message(chat.role):
+                st.markdown(chat.content)
 
                 # assistantメッセージの場合は常にモード表示
-                if chat["role"] == "assistant":
-                    if chat.get("is_rag") and chat.get("chunks"):
+                if chat.role == "assistant":
+                    if chat.is_rag and chat.chunks:
                         # RAGモード
                         st.info("📚 **RAGモード**: 資料を参照して回答を生成しました")
-                        with st.expander("📖 参照した資料の詳細を見る", expanded=False):
-                            for i, chunk in enumerate(chat["chunks"], 1):
-                                # ファイル名を取得
-                                source = chunk.get('source', '不明')
-
-                                # Googleドライブリンクを取得
-                                if self.rag_manager:
-                                    drive_link = self.rag_manager.get_google_drive_link(source)
-                                else:
-                                    drive_link = ""
-
-                                # リンクがあればクリック可能に、なければ通常表示
-                                if drive_link:
-                                    st.markdown(f"**[{i}]** [{source}]({drive_link}) 📄")
-                                else:
-                                    st.markdown(f"**[{i}]** {source}")
-
-                                # 類似度スコアを表示
-                                score = chunk.get('similarity_score', 0)
-                                st.markdown(f"**類似度スコア**: {score:.4f} (スコアが低いほど関連性が高い)")
-
-                                # 最後以外は区切り線を入れる
-                                if i < len(chat["chunks"]):
-                                    st.divider()
+                        self._render_chunk_references(
+                            self._build_chunk_reference_items(chat.chunks)
+                        )
                     else:
                         # 通常モード
                         st.info("💬 **通常モード**: RAG資料に関連情報がないため、一般知識で回答しました")
@@ -483,15 +636,20 @@ class GUI:
         # ChatManagerに保存(session_stateとFirestoreも更新)
         self._add_user_message(user_input)
 
+        # 🆕 タイトル生成が必要ならこの時点で裏で開始する
+        # (応答ストリーミングと並行して走り、往復が1回分重なる)
+        title_future = self.chat_manager.begin_title_generation(
+            st.session_state.current_chat["id"]
+        )
+
         # RAGモードか通常モードか判定してAI応答を取得
         self._process_ai_response_with_rag(user_input)
-        
-        # AI応答完了後にタイトルを自動生成
-        title_generated = self._auto_generate_title_if_needed()
-        
-        # タイトルが生成された場合は画面を再描画
-        if title_generated:
-            st.rerun()
+
+        # AI応答完了後にタイトルを反映
+        # (生成された場合もタイトル要素だけをその場で更新するため、
+        # st.rerun()による全体再実行は行わない。サイドバーのラベルは
+        # 次の自然な再実行で揃う)
+        self._auto_generate_title_if_needed(title_future)
 
     def _process_ai_response_with_rag(self, user_input: str):
         """
@@ -519,10 +677,18 @@ class GUI:
 
             if self.rag_manager:
                 message_placeholder.markdown("🔍 関連資料を検索中...")
-                rag_data = self.rag_manager.get_rag_response_data(user_input)
+                # 🆕 検索(数百ms)と履歴整形は独立なので並列化する
+                # 検索を裏スレッドに投げ、待ち時間で履歴整形を済ませる
+                rag_future = _RAG_EXECUTOR.submit(
+                    self.rag_manager.get_rag_response_data, user_input
+                )
+                formatted_histories = self.chat_manager.get_formatted_histories(current_id)
+                rag_data = rag_future.result()
                 use_rag = rag_data["use_rag"]
                 rag_context = rag_data.get("context", "")
                 search_results = rag_data.get("search_results", [])
+            else:
+                formatted_histories = self.chat_manager.get_formatted_histories(current_id)
 
             # 回答生成
             full_response = ""
@@ -534,72 +700,53 @@ class GUI:
                 # RAGプロンプトを作成
                 rag_prompt = rag_data["prompt"]
 
-                # 会話履歴を取得（RAGプロンプトを最後に追加）
-                chat_histories = self.chat_manager.get_chat_histories(current_id)
-                formatted_messages = self.chat_manager.format_chat_histories(chat_histories[:-1])  # 最後のユーザー入力は除く
+                # 会話履歴(検索と並行して整形済み)の最後のユーザー入力を除く
+                formatted_messages = formatted_histories[:-1]
 
                 # RAGプロンプトをHumanMessageとして追加
                 formatted_messages.append(
                     self.langchain_manager.create_human_message(rag_prompt)
                 )
 
-                # RAGモードでストリーミング応答を取得
-                for chunk in self.langchain_manager.get_streaming_response_rag(formatted_messages):
-                    full_response += chunk
-                    message_placeholder.markdown(full_response)
+                # RAGモードでストリーミング応答を取得(バッチ描画)
+                full_response = _stream_to_placeholder(
+                    message_placeholder,
+                    self.langchain_manager.get_streaming_response_rag(formatted_messages)
+                )
             else:
                 # 通常モードで回答
                 message_placeholder.markdown("🤔 AIが考え中だよ...ちょっと待ってね!")
 
-                # 会話履歴を取得してフォーマット
-                chat_histories = self.chat_manager.get_chat_histories(current_id)
-                formatted_messages = self.chat_manager.format_chat_histories(chat_histories)
+                # 会話履歴(検索と並行して整形済み)をそのまま使う
+                formatted_messages = formatted_histories
 
-                # 通常モードでストリーミング応答を取得
-                for chunk in self.langchain_manager.get_streaming_response(formatted_messages):
-                    full_response += chunk
-                    message_placeholder.markdown(full_response)
+                # 通常モードでストリーミング応答を取得(バッチ描画)
+                full_response = _stream_to_placeholder(
+                    message_placeholder,
+                    self.langchain_manager.get_streaming_response(formatted_messages)
+                )
 
             # RAGを使ったかどうかを表示
             if use_rag and search_results:
                 st.info("📚 **RAGモード**: 資料を参照して回答を生成しました")
-                with st.expander("📖 参照した資料の詳細を見る", expanded=False):
-                    for i, doc in enumerate(search_results, 1):
-                        # ファイル名とページ番号を取得
-                        source = doc['metadata'].get('source', '不明')
-                        page = doc['metadata'].get('page', '?')
-                        
-                        # Googleドライブリンクを取得
-                        drive_link = self.rag_manager.get_google_drive_link(source)
-                        
-                        # リンクがあればクリック可能に、なければ通常表示
-                        if drive_link:
-                            st.markdown(f"**[{i}]** [{source}]({drive_link}) (ページ {page}) 📄")
-                        else:
-                            st.markdown(f"**[{i}]** {source} (ページ {page})")
-                        
-                        # 参照したテキストの抜粋を表示
-                        st.markdown(f"> {doc['text'][:200]}...")
-                        
-                        # 類似度スコアを表示
-                        st.markdown(f"**類似度スコア**: {doc['distance']:.4f} (スコアが低いほど関連性が高い)")
-                        
-                        # 最後以外は区切り線を入れる
-                        if i < len(search_results):
-                            st.divider()
+                self._render_chunk_references(
+                    self._build_chunk_reference_items(search_results, with_page=True)
+                )
             else:
                 st.info("💬 **通常モード**: RAG資料に関連情報がないため、一般知識で回答しました")
 
         # 🆕 Firestore保存用のchunks形式に変換
+        # (chunk_id/sourceはRAGManagerがフラット化済みなので詰め替えるだけ)
         chunks_to_save = None
         if use_rag and search_results:
-            chunks_to_save = []
-            for doc in search_results:
-                chunks_to_save.append({
-                    "chunk_id": f"{doc['metadata'].get('source', '')}_{doc['metadata'].get('page', '')}_{doc['metadata'].get('chunk_index', '')}",
-                    "similarity_score": doc['distance'],
-                    "source": doc['metadata'].get('source', '不明')
-                })
+            chunks_to_save = [
+                {
+                    "chunk_id": doc["chunk_id"],
+                    "similarity_score": doc["distance"],
+                    "source": doc["source"]
+                }
+                for doc in search_results
+            ]
 
         # ChatManagerに保存（Firestoreにも保存される）
         self._add_ai_message(
@@ -631,16 +778,14 @@ class GUI:
             # 完全な応答を格納する変数
             full_response = ""
             
-            # ChatManagerから現在の会話履歴を取得
-            chat_histories = self.chat_manager.get_chat_histories(current_id)
+            # ChatManagerから整形済みの会話履歴を取得(キャッシュ利用)
+            formatted_messages = self.chat_manager.get_formatted_histories(current_id)
             
-            # LangChain用にフォーマット
-            formatted_messages = self.chat_manager.format_chat_histories(chat_histories)
-            
-            # ストリーム応答を取得
-            for chunk in self.langchain_manager.get_streaming_response(formatted_messages):
-                full_response += chunk
-                message_placeholder.markdown(full_response)
+            # ストリーム応答を取得(バッチ描画)
+            full_response = _stream_to_placeholder(
+                message_placeholder,
+                self.langchain_manager.get_streaming_response(formatted_messages)
+            )
         
         # ChatManagerに保存（Firestoreにも保存される）
         self._add_ai_message(full_response)
@@ -19,6 +19,136 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 # 型ヒント用
 from typing import List, Generator
+from functools import lru_cache
+import time
+
+import httpx
+
+# 🆕 システムプロンプトはモジュール定数に昇格
+# (毎回同じ文字列をメソッド内で組み立て直す必要はない。
+# バイト単位で同一の文字列を送り続けることは、プロバイダー側の
+# プレフィックスキャッシュにも効く)
+#
+# トークン数の事前計算について: このアプリのチェーン(stream/invoke/batch)は
+# クライアント側でtiktokenを走らせない(BPEはget_num_tokens系を明示的に
+# 呼んだ場合のみ)。そのためプロンプトのトークンIDを起動時に前計算しても
+# 節約できる処理がなく、tiktokenのBPE辞書ロードぶん起動が遅くなるだけ
+# なので行っていない。トークン数カウントを導入する場合は
+# functools.lru_cacheでencodeを包むこと
+_CHAT_SYSTEM_PROMPT = (
+    "あなたはフレンドリーで親切なAIアシスタントです。"
+    "ユーザーの質問に対して、明るくわかりやすく丁寧に答えてください。"
+)
+
+_TITLE_SYSTEM_PROMPT = """以下の会話内容を要約して、12文字以内の短いタイトルを生成してください。
+
+ルール:
+- 12文字以内で簡潔に
+- 会話の主要なテーマを捉える
+- 「〜について」などの余計な言葉は省く
+- タイトルのみを出力(説明文は不要)
+
+例:
+会話: Pythonの基本文法について教えて → タイトル: Python文法
+会話: おすすめのカフェを教えて → タイトル: おすすめカフェ
+会話: ストレス解消法について → タイトル: ストレス解消"""
+
+_RAG_SYSTEM_PROMPT = """あなたはアコム ネットサービスセンターの業務サポートAIです。
+
+【重要なルール】
+1. 回答の冒頭に「NSC業務フローに基づき」または「ネットサービスセンターのローカルルールによると」という接頭語を付けてください
+2. 参照資料に書かれている情報のみを使用してください
+3. 参照資料にない情報は「資料に記載がありません」と正直に伝えてください
+4. 具体的なコード名やルール名（NSCコード、NG理由コード表など）がある場合は、それを明記してください
+5. 分かりやすく、丁寧に回答してください
+
+参照資料がある場合は、それに基づいて回答します。"""
+
+
+@lru_cache(maxsize=1)
+def _get_http_client() -> httpx.Client:
+    """
+    🆕 OpenAI API用のHTTPクライアントのシングルトンを取得
+
+    ChatOpenAIを作り直すたびに新しい接続プールを張ると、
+    次のリクエストでTCP+TLSハンドシェイク(~100ms)をやり直すことになる。
+    keep-aliveの接続プールをプロセス内で1つだけ持ち、
+    チャット/タイトル/RAGの全チェーンで使い回す
+    """
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=32,
+            max_keepalive_connections=16
+        ),
+        timeout=60
+    )
+
+
+# 🆕 ストリーミングチャンクの結合設定
+# トークン1つごとにyieldすると呼び出し側(Streamlitの描画)が
+# チャンク数ぶん駆動されるため、小さな時間窓で複数チャンクを
+# 1つの文字列にまとめてからyieldする
+_STREAM_BATCH_WINDOW = 0.05     # 秒: この間隔を超えたら必ずflush
+_STREAM_BATCH_GROWTH = 3        # flushごとに目標サイズを3倍に伸ばす
+_STREAM_BATCH_MAX_CHARS = 32    # 目標サイズの上限(文字数)
+
+
+def _batch_stream(stream) -> Generator[str, None, None]:
+    """
+    🆕 ストリーミングチャンクを成長係数つきでまとめるラッパー
+
+    最初は1文字で即yieldするため最初のトークンの表示は遅れない。
+    flushのたびに目標サイズを3倍(最大32文字)へ伸ばすので、
+    応答が長くなるほどyield回数が減っていく
+
+    Args:
+        stream: トークンチャンクを返すイテレーター
+
+    Yields:
+        str: まとめられたチャンク
+    """
+    buf = []
+    buf_len = 0
+    target = 1
+    last_flush = time.monotonic()
+
+    for chunk in stream:
+        if not chunk:
+            continue
+        buf.append(chunk)
+        buf_len += len(chunk)
+
+        now = time.monotonic()
+        if buf_len >= target or now - last_flush >= _STREAM_BATCH_WINDOW:
+            yield "".join(buf)
+            buf = []
+            buf_len = 0
+            target = min(target * _STREAM_BATCH_GROWTH, _STREAM_BATCH_MAX_CHARS)
+            last_flush = now
+
+    # 残りを必ず出し切る
+    if buf:
+        yield "".join(buf)
+
+
+@lru_cache(maxsize=8)
+def _build_template(system_text: str) -> ChatPromptTemplate:
+    """
+    🆕 システムプロンプトからChatPromptTemplateを構築(メモ化)
+
+    テンプレートのパースは毎回同じ結果になるため、同じシステム
+    プロンプトに対しては一度だけ構築して使い回す
+
+    Args:
+        system_text: システムプロンプト文字列
+
+    Returns:
+        ChatPromptTemplateのインスタンス
+    """
+    return ChatPromptTemplate.from_messages([
+        ("system", system_text),
+        MessagesPlaceholder(variable_name="messages")
+    ])
 
 
 class LangChainManager:
@@ -93,7 +223,9 @@ class LangChainManager:
         """
         return ChatOpenAI(
             model=self.model,
-            temperature=self.temperature
+            temperature=self.temperature,
+            # 🆕 共有のkeep-alive接続プールを使い回す
+            http_client=_get_http_client()
         )
     
     def _create_prompt(self) -> ChatPromptTemplate:
@@ -120,15 +252,10 @@ class LangChainManager:
         
         今回は方法②を使っている
             ChatPromptTemplate.from_messages() はクラスメソッド
-        
+
         """
-        return ChatPromptTemplate.from_messages([
-            (
-                "system",
-                "あなたはフレンドリーで親切なAIアシスタントです。ユーザーの質問に対して、明るくわかりやすく丁寧に答えてください。"
-            ),
-            MessagesPlaceholder(variable_name="messages")
-        ])
+        # 定数プロンプトからメモ化済みテンプレートを取得
+        return _build_template(_CHAT_SYSTEM_PROMPT)
     
     def _create_title_prompt(self) -> ChatPromptTemplate:
         """
@@ -141,24 +268,7 @@ class LangChainManager:
         【戻り値】
         ChatPromptTemplateのインスタンス
         """
-        return ChatPromptTemplate.from_messages([
-            (
-                "system",
-                """以下の会話内容を要約して、12文字以内の短いタイトルを生成してください。
-                
-ルール:
-- 12文字以内で簡潔に
-- 会話の主要なテーマを捉える
-- 「〜について」などの余計な言葉は省く
-- タイトルのみを出力(説明文は不要)
-
-例:
-会話: Pythonの基本文法について教えて → タイトル: Python文法
-会話: おすすめのカフェを教えて → タイトル: おすすめカフェ
-会話: ストレス解消法について → タイトル: ストレス解消"""
-            ),
-            MessagesPlaceholder(variable_name="messages")
-        ])
+        return _build_template(_TITLE_SYSTEM_PROMPT)
     
     def _create_rag_prompt(self) -> ChatPromptTemplate:
         """
@@ -171,22 +281,7 @@ class LangChainManager:
         【戻り値】
         ChatPromptTemplateのインスタンス
         """
-        return ChatPromptTemplate.from_messages([
-            (
-                "system",
-                """あなたはアコム ネットサービスセンターの業務サポートAIです。
-
-【重要なルール】
-1. 回答の冒頭に「NSC業務フローに基づき」または「ネットサービスセンターのローカルルールによると」という接頭語を付けてください
-2. 参照資料に書かれている情報のみを使用してください
-3. 参照資料にない情報は「資料に記載がありません」と正直に伝えてください
-4. 具体的なコード名やルール名（NSCコード、NG理由コード表など）がある場合は、それを明記してください
-5. 分かりやすく、丁寧に回答してください
-
-参照資料がある場合は、それに基づいて回答します。"""
-            ),
-            MessagesPlaceholder(variable_name="messages")
-        ])
+        return _build_template(_RAG_SYSTEM_PROMPT)
     
     def create_human_message(self, content: str) -> HumanMessage:
         """
@@ -265,8 +360,8 @@ class LangChainManager:
         """
         # self.chain.stream()でAIにメッセージを送信
         # {"messages": messages} で、プロンプトの{messages}部分に履歴を埋め込む
-        for chunk in self.chain.stream({"messages": messages}):
-            yield chunk
+        # 🆕 チャンクは成長係数つきバッチでまとめてからyieldする
+        yield from _batch_stream(self.chain.stream({"messages": messages}))
     
     def get_streaming_response_rag(
         self,
@@ -274,10 +369,18 @@ class LangChainManager:
     ) -> Generator[str, None, None]:
         """
         🆕 RAGモード用のストリーミング応答を取得
-        
+
         【処理内容】
         RAG用のプロンプト(rag_chain)を使ってストリーミング応答を取得
-        
+
+        【メッセージ順序の注意】
+        実際に送られる順序は
+        「静的システムプロンプト → 会話履歴(追記のみ) → 動的な資料+質問」。
+        先頭側がターンをまたいでバイト単位で同一に保たれるため、
+        プロバイダーのプレフィックスキャッシュが効く。検索結果などの
+        毎ターン変わる内容をシステムプロンプトや履歴より前に
+        差し込むと、このキャッシュが全て外れるので順序を変えないこと
+
         Args:
             messages: LangChain形式のメッセージ履歴リスト
                       （RAGプロンプトを含む）
@@ -289,8 +392,8 @@ class LangChainManager:
         for chunk in langchain_manager.get_streaming_response_rag(messages):
             print(chunk)
         """
-        for chunk in self.rag_chain.stream({"messages": messages}):
-            yield chunk
+        # 🆕 チャンクは成長係数つきバッチでまとめてからyieldする
+        yield from _batch_stream(self.rag_chain.stream({"messages": messages}))
     
     def get_complete_response(
         self,
@@ -319,6 +422,33 @@ class LangChainManager:
         print(response)  # "こんにちは!調子はどう?" と一気に表示
         """
         return self.chain.invoke({"messages": messages})
+
+    def batch_invoke(self, batches: List[List]) -> List[str]:
+        """
+        🆕 複数のメッセージ列をまとめて処理して応答リストを返す
+
+        【処理内容】
+        LangChainの.batch()を使い、複数のリクエストを並行に送る
+        (内部で非同期+接続プールが使われるため、1件ずつinvokeを
+        直列に呼ぶよりRTTが重なって合計時間がほぼ1件分になる)
+
+        Args:
+            batches: メッセージ履歴リストのリスト
+                [[HumanMessage(...), ...], [HumanMessage(...), ...], ...]
+
+        Returns:
+            各メッセージ列に対応する応答のリスト(入力と同じ順序)
+
+        【呼び出し例】(バッチ処理スクリプトなどで)
+        responses = langchain_manager.batch_invoke([messages_a, messages_b])
+        """
+        if not batches:
+            return []
+
+        return self.chain.batch(
+            [{"messages": messages} for messages in batches],
+            config={"max_concurrency": 8}
+        )
     
     def generate_title(self, messages: List) -> str:
         """
@@ -339,17 +469,26 @@ class LangChainManager:
         title = langchain_manager.generate_title(formatted_messages)
         # title = "Python基本文法"
         """
+        # 🆕 タイトルに必要なのは最初のやり取りだけ
+        # 会話全体を送るとプロンプトトークンが会話の長さに比例して
+        # 増えるため、先頭2件に絞り、長いメッセージは200文字に切り詰める
+        # (タイトルはほぼ質問文で決まるので品質への影響はない)
+        trimmed = []
+        for message in messages[:2]:
+            content = message.content
+            if len(content) > 200:
+                message = message.__class__(content=content[:200])
+            trimmed.append(message)
+
         # タイトル生成チェーンを実行
-        title = self.title_chain.invoke({"messages": messages})
+        title = self.title_chain.invoke({"messages": trimmed})
         
         # 余計な空白や改行を削除
         title = title.strip()
-        
-        # 15文字を超えた場合は切り詰める
-        if len(title) > 15:
-            title = title[:15]
-        
-        return title
+
+        # 15文字を超えた場合のみ切り詰める
+        # (モデルはほぼ12文字以内で返すので、大半はスライスなしで返る)
+        return title if len(title) <= 15 else title[:15]
     
     def update_system_prompt(self, new_system_prompt: str):
         """
@@ -367,11 +506,8 @@ class LangChainManager:
         langchain_manager.update_system_prompt("あなたは厳しい先生です")
         # この後のAI応答は「厳しい先生」として振る舞う
         """
-        # 新しいプロンプトテンプレートを作成
-        self.prompt = ChatPromptTemplate.from_messages([
-            ("system", new_system_prompt),
-            MessagesPlaceholder(variable_name="messages")
-        ])
+        # 新しいプロンプトテンプレートを作成(同じ文字列ならメモ化が効く)
+        self.prompt = _build_template(new_system_prompt)
         # チェーンを再構築
         self.chain = self.prompt | self.llm | self.output_parser
     
@@ -402,13 +538,25 @@ class LangChainManager:
         # 両方変更
         langchain_manager.update_model_settings(model="gpt-4", temperature=0.5)
         """
-        # modelが指定されていれば(is not None)更新
-        if model is not None:
-            self.model = model
+        # 🆕 設定が実質変わらない場合は何もしない
+        # (ChatOpenAIの再生成と3本のチェーン再構築を丸ごと省略できる)
+        if model is None or model == self.model:
+            if temperature is None or temperature == self.temperature:
+                return
+
+            # 🆕 temperatureだけの変更はChatOpenAIを作り直さず
+            # その場で反映する(チェーンは同じllmオブジェクトを
+            # 参照しているので再構築も不要)
+            self.temperature = temperature
+            self.llm.temperature = temperature
+            return
+
+        # モデルが変わる場合はLLMを作り直す
+        self.model = model
         # temperatureが指定されていれば更新
         if temperature is not None:
             self.temperature = temperature
-        
+
         # 新しい設定でLLMを再初期化
         self.llm = self._initialize_llm()
         # チェーンを再構築
@@ -10,11 +10,6 @@
 """
 from dotenv import load_dotenv
 import streamlit as st
-from chat.gui import GUI
-from chat.chat_manager import ChatManager
-from chat.langchain_manager import LangChainManager
-from chat.db_manager import DBManager
-from chat.rag_manager import RAGManager
 
 # 環境変数の読み込み
 load_dotenv()
@@ -22,18 +17,53 @@ load_dotenv()
 # ページ設定
 st.set_page_config(page_title="さくらのAIチャットボット", layout="wide")
 
-# 各マネージャーの初期化
-db_manager = DBManager()
-langchain_manager = LangChainManager()
-chat_manager = ChatManager(db_manager, langchain_manager)
+# 🆕 重いマネージャーはst.cache_resourceでプロセス内シングルトンにする
+# (Firestore接続・LLMクライアント・ChromaDBは再実行やセッションをまたいで
+# 使い回せる。毎回作り直すと接続やクライアント初期化のコストがかかる)
+#
+# 🆕 重い依存(langchain_openai / chromadb / fitz など)を引き込むimportは
+# 各ファクトリー内に移した。シングルトン構築は初回の1回だけなので、
+# import自体もプロセスで1回だけ実行され、コールドスタートの
+# モジュールロード時間がGUI表示に必要な最小限だけになる
+
+
+@st.cache_resource(show_spinner=False)
+def get_db_manager():
+    """DBManagerのシングルトンを返す"""
+    from chat.db_manager import DBManager
+    return DBManager()
+
+
+@st.cache_resource(show_spinner=False)
+def get_langchain_manager():
+    """LangChainManagerのシングルトンを返す"""
+    from chat.langchain_manager import LangChainManager
+    return LangChainManager()
+
 
-# RAGManagerの初期化
-rag_manager = RAGManager(
-    documents_dir="data/documents",
-    chroma_dir="data/chroma_db",
-    collection_name="acom_documents",
-    threshold=1.5
-)
+@st.cache_resource(show_spinner=False)
+def get_rag_manager():
+    """RAGManagerのシングルトンを返す"""
+    from chat.rag_manager import RAGManager
+    return RAGManager(
+        documents_dir="data/documents",
+        chroma_dir="data/chroma_db",
+        collection_name="acom_documents",
+        threshold=1.5
+    )
+
+
+db_manager = get_db_manager()
+langchain_manager = get_langchain_manager()
+rag_manager = get_rag_manager()
+
+# ChatManagerとGUIはセッションごとの状態(session_state)を扱うため
+# キャッシュせず再実行のたびに軽量なインスタンスを作る
+# (importは2回目以降sys.modulesのキャッシュヒットなので実質無料)
+from chat.chat_manager import ChatManager
+from chat.gui import GUI
+
+chat_manager = ChatManager(db_manager, langchain_manager)
 
 # GUIの初期化（RAGManagerを渡す）
 gui = GUI(chat_manager, langchain_manager, rag_manager)
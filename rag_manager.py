@@ -8,19 +8,47 @@
 - RAGモードと通常モードの判定
 - RAG用プロンプトの生成
 """
+import hashlib
 import os
+import sqlite3
+import time
+import types
+import unicodedata
+from collections import OrderedDict
 from typing import List, Dict, Any, Tuple, Optional
 from pathlib import Path
 
+import numpy as np
+import orjson
+
 from chat.document_processor import DocumentProcessor
 from chat.chroma_manager import ChromaManager
+from chat.app_logging import get_logger
+
+# モジュール共通のロガー(printと違い、書き込みは専用スレッドにオフロードされる)
+logger = get_logger(__name__)
+
+# 🆕 意味的レスポンスキャッシュの設定
+# 「審査の流れを教えて」と「審査フロー教えて」のような言い換えを
+# 埋め込みのコサイン類似度で同一視し、2回目以降のChroma検索と
+# コンテキスト構築を丸ごと省略する
+_RESP_CACHE_SIZE = 256        # LRUで保持する最大件数
+_RESP_CACHE_THRESHOLD = 0.95  # 類似度がこれ以上なら同じ質問とみなす
+
+# 🆕 これより短い質問は検索せず通常モードに落とす(文字数)
+# 空文字や「?」だけの誤送信・二重送信で埋め込みAPIとANN検索
+# (合わせて50〜200ms)を無駄に走らせない。日本語は1〜2文字でも
+# 意味を持つ(「審査」など)ため、閾値は控えめに2にしている
+_MIN_RAG_QUERY_CHARS = 2
 
 # Googleドライブのファイルリンクマッピング
-GOOGLE_DRIVE_LINKS = {
+# 🆕 MappingProxyTypeで読み取り専用にする(実行中に書き換えられる
+# ことがないと保証でき、うっかり変更も防げる)
+GOOGLE_DRIVE_LINKS = types.MappingProxyType({
     "acom_customer_record_rules.pdf": "https://drive.google.com/file/d/1x7v3R6Fqphg96j-VaK6bX26zF3LoW9qi/view?usp=drive_link",
     "acom_documents_mapping.pdf": "https://drive.google.com/file/d/1x48SomSfB3L0m7v85jotNB1cNQ2e36aE/view?usp=drive_link",
     "acom_workflow_rag.pdf": "https://drive.google.com/file/d/1nJv48_0QCg6BF-wyXYR0mvjSF5wiITYY/view?usp=drive_link"
-}
+})
 
 class RAGManager:
     """
@@ -66,7 +94,7 @@ class RAGManager:
         )
         """
         self.documents_dir = documents_dir
-        self.threshold = threshold
+        self._threshold = threshold
         
         # ディレクトリ作成
         Path(documents_dir).mkdir(parents=True, exist_ok=True)
@@ -83,9 +111,54 @@ class RAGManager:
             collection_name=collection_name
         )
         
-        print(f"✅ RAGManager初期化完了")
-        print(f"   ドキュメント格納先: {documents_dir}")
-    
+        # 🆕 意味的レスポンスキャッシュ
+        # 正規化した質問文 → (正規化済み埋め込みベクトル, get_rag_response_dataの結果)
+        self._resp_cache: "OrderedDict[str, Tuple[np.ndarray, Dict[str, Any]]]" = OrderedDict()
+        # 埋め込みを縦に積んだ行列(コサイン類似度を1回の行列積で計算するため。
+        # キャッシュ更新時にNoneに戻し、次の検索時に作り直す)
+        self._resp_cache_matrix: Optional[np.ndarray] = None
+        self._resp_cache_keys: List[str] = []
+
+        # 🆕 レスポンスキャッシュの永続化(SQLite)
+        # Streamlitの再起動でキャッシュの温まりを失わないよう、
+        # エントリをWALモードのSQLiteにも書いておき、起動時に読み戻す
+        self._resp_cache_path = Path(chroma_dir).parent / "response_cache.sqlite"
+        self._resp_db: Optional[sqlite3.Connection] = None
+        self._load_resp_cache()
+
+        logger.info(f"✅ RAGManager初期化完了")
+        logger.info(f"   ドキュメント格納先: {documents_dir}")
+
+    @property
+    def threshold(self) -> float:
+        """RAG使用判定の閾値"""
+        return self._threshold
+
+    @threshold.setter
+    def threshold(self, value: float):
+        """
+        🆕 閾値の変更時にレスポンスキャッシュを無効化する
+
+        キャッシュ済みのuse_rag判定と検索結果は古い閾値の下で
+        計算されたものなので、サイドバーのスライダーで閾値が
+        変わったらまとめて捨てる(SQLiteの永続化分も含む)
+        """
+        if value == self._threshold:
+            return
+
+        self._threshold = value
+        self._clear_resp_cache()
+
+        if self._resp_db is not None:
+            try:
+                self._resp_db.execute(
+                    "INSERT OR REPLACE INTO response_cache_meta "
+                    "VALUES ('threshold', ?)",
+                    (str(value),)
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ 閾値メタ保存エラー: {e}")
+
     def process_and_store_pdf(self, pdf_path: str) -> bool:
         """
         PDFを処理してChromaDBに格納（単一ファイル）
@@ -104,7 +177,7 @@ class RAGManager:
         【呼び出し例】
         rag.process_and_store_pdf("data/documents/rules.pdf")
         """
-        print(f"\n📄 PDF処理開始: {pdf_path}")
+        logger.info(f"\n📄 PDF処理開始: {pdf_path}")
         
         # チャンクに分割
         chunks = self.document_processor.process_pdf(pdf_path)
@@ -114,9 +187,31 @@ class RAGManager:
         
         # ChromaDBに格納
         result = self.chroma_manager.add_documents(chunks)
-        
+
         return result
-    
+
+    def _process_and_store_file(self, file_path: str) -> bool:
+        """
+        🆕 拡張子に応じてPDF/HTMLを処理してChromaDBに格納
+
+        全件登録のprocess_directory()と同じく.htmlも扱えるよう、
+        sync_documents()からはこちらを経由する
+
+        Args:
+            file_path: PDFまたはHTMLファイルのパス
+
+        Returns:
+            成功した場合True
+        """
+        if file_path.lower().endswith(".html"):
+            logger.info(f"\n📄 HTML処理開始: {file_path}")
+            chunks = self.document_processor.process_html(file_path)
+            if not chunks:
+                return False
+            return self.chroma_manager.add_documents(chunks)
+
+        return self.process_and_store_pdf(file_path)
+
     def process_all_pdfs(self) -> bool:
         """
         ドキュメントディレクトリ内の全PDFを処理
@@ -131,7 +226,7 @@ class RAGManager:
         【呼び出し例】
         rag.process_all_pdfs()
         """
-        print(f"\n📁 ディレクトリ処理開始: {self.documents_dir}")
+        logger.info(f"\n📁 ディレクトリ処理開始: {self.documents_dir}")
         
         # 全PDFをチャンク化
         all_chunks = self.document_processor.process_directory(self.documents_dir)
@@ -163,15 +258,36 @@ class RAGManager:
         
         Returns:
             (関連ドキュメントリスト, RAGを使うべきか)
-        
+            各ドキュメントはフラットな辞書:
+            {"chunk_id": "...", "source": "...", "page": 3,
+             "text": "...", "distance": 0.42}
+
         【呼び出し例】
         results, use_rag = rag.query("書類不備の対応は？")
         """
-        return self.chroma_manager.search_with_threshold(
+        results, use_rag = self.chroma_manager.search_with_threshold(
             query=user_question,
             threshold=self.threshold,
             n_results=n_results
         )
+
+        # 🆕 metadataのネストをここで1回だけ解いてフラットな辞書にする
+        # (保存用chunk_idの組み立てや参照資料の描画側で、結果ごとに
+        # 何度もmetadataを辿らずに済む)
+        flattened = []
+        for result in results:
+            metadata = result.get("metadata", {})
+            source = metadata.get("source", "不明")
+            page = metadata.get("page", "?")
+            flattened.append({
+                "chunk_id": f"{source}_{page}_{metadata.get('chunk_index', '')}",
+                "source": source,
+                "page": page,
+                "text": result["text"],
+                "distance": result["distance"]
+            })
+
+        return flattened, use_rag
     
     def build_rag_context(
         self,
@@ -200,19 +316,13 @@ class RAGManager:
         """
         if not search_results:
             return ""
-        
-        context_parts = []
-        
-        for i, result in enumerate(search_results, start=1):
-            source = result["metadata"].get("source", "不明")
-            page = result["metadata"].get("page", "?")
-            text = result["text"]
-            
-            context_parts.append(
-                f"【参照資料{i}】({source} / ページ{page})\n{text}"
-            )
-        
-        return "\n\n".join(context_parts)
+
+        # ジェネレーター式を直接joinに渡し、使い捨てのリストを作らない
+        # (n_resultsを増やした場合も中間リスト分の割り当てが不要)
+        return "\n\n".join(
+            f"【参照資料{i}】({result['source']} / ページ{result['page']})\n{result['text']}"
+            for i, result in enumerate(search_results, start=1)
+        )
     
     def build_rag_prompt(
         self,
@@ -226,22 +336,25 @@ class RAGManager:
         参照資料とユーザーの質問を組み合わせて
         AIに渡すプロンプトを作成
         
+        【補足】
+        回答ルール(接頭語や「資料にない情報は使わない」など)は
+        LangChainManagerのRAG用システムプロンプト側に定義されている。
+        以前はここでも同じルールを毎ターン繰り返していたが、
+        静的な指示はバイト単位で同一のシステムプロンプトに寄せ、
+        このメッセージには動的な内容(資料+質問)だけを載せる
+        (プロバイダーの自動プレフィックスキャッシュが効く形)。
+        静的な前置きを別途組み立てて連結する処理は残っていない
+        (f-stringリテラルの固定部分はコンパイル時定数)ため、
+        呼び出しごとの文字列構築は資料と質問の埋め込み1回だけ
+
         Args:
             user_question: ユーザーの質問
             context: build_rag_context()で作成したコンテキスト
-        
+
         Returns:
             RAG用プロンプト
         """
-        return f"""以下の参照資料に基づいて、ユーザーの質問に回答してください。    
-
-【重要なルール】
-1. NSC業務フローに基づき、またはネットサービスセンターのローカルルールによると、という接頭語を付けて回答してください
-2. 参照資料に書かれている情報のみを使用してください
-3. 参照資料にない情報は「資料に記載がありません」と伝えてください
-4. 具体的なコード名やルール名がある場合は、それを明記してください
-
-===== 参照資料 =====
+        return f"""===== 参照資料 =====
 {context}
 ====================
 
@@ -249,6 +362,208 @@ class RAGManager:
 
 上記の参照資料に基づいて回答してください:"""
     
+    def _load_resp_cache(self):
+        """
+        🆕 SQLiteからレスポンスキャッシュを読み戻す
+
+        永続化に失敗してもキャッシュが効かなくなるだけなので、
+        エラー時は警告を出してメモリのみの動作にフォールバックする
+        """
+        try:
+            self._resp_db = sqlite3.connect(
+                str(self._resp_cache_path),
+                isolation_level=None,      # 自動コミット(書き込みごとのBEGIN不要)
+                check_same_thread=False    # 検索はワーカースレッドから呼ばれ得る
+            )
+            self._resp_db.execute("PRAGMA journal_mode=WAL")
+            self._resp_db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "norm_q TEXT PRIMARY KEY, "
+                "embedding BLOB, "
+                "response TEXT, "
+                "ts INTEGER)"
+            )
+
+            # 🆕 保存時の閾値をメタテーブルに残しておき、
+            # 前回と閾値が違う状態で起動したら読み戻さずに破棄する
+            # (キャッシュ済みのuse_rag判定は閾値に依存するため)
+            self._resp_db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache_meta ("
+                "key TEXT PRIMARY KEY, "
+                "value TEXT)"
+            )
+            row = self._resp_db.execute(
+                "SELECT value FROM response_cache_meta WHERE key = 'threshold'"
+            ).fetchone()
+            if row is not None and float(row[0]) != self.threshold:
+                logger.info("🧹 閾値が変わったため永続キャッシュを破棄します")
+                self._resp_db.execute("DELETE FROM response_cache")
+            self._resp_db.execute(
+                "INSERT OR REPLACE INTO response_cache_meta "
+                "VALUES ('threshold', ?)",
+                (str(self.threshold),)
+            )
+
+            # 古い順に読み込むと、OrderedDictの並びがそのままLRU順になる
+            rows = self._resp_db.execute(
+                "SELECT norm_q, embedding, response FROM response_cache "
+                "ORDER BY ts LIMIT ?",
+                (_RESP_CACHE_SIZE,)
+            ).fetchall()
+
+            for norm_q, emb_blob, response in rows:
+                self._resp_cache[norm_q] = (
+                    np.frombuffer(emb_blob, dtype=np.float32),
+                    orjson.loads(response)
+                )
+
+            if rows:
+                logger.info(f"✅ レスポンスキャッシュ読み込み: {len(rows)}件")
+
+        except Exception as e:
+            logger.warning(f"⚠️ レスポンスキャッシュ読み込みエラー: {e}")
+            self._resp_db = None
+
+    def _persist_resp_cache_entry(
+        self,
+        norm_q: str,
+        embedding: np.ndarray,
+        rag_data: Dict[str, Any]
+    ):
+        """
+        🆕 キャッシュエントリ1件をSQLiteに書き込む
+        """
+        if self._resp_db is None:
+            return
+
+        try:
+            self._resp_db.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)",
+                (
+                    norm_q,
+                    embedding.tobytes(),
+                    orjson.dumps(rag_data),
+                    int(time.time())
+                )
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ レスポンスキャッシュ保存エラー: {e}")
+
+    @staticmethod
+    def _normalize_question(user_question: str) -> str:
+        """
+        🆕 キャッシュキー用に質問文を正規化する(NFKC・前後空白除去・小文字化)
+
+        全角/半角や大文字/小文字の揺れだけが違う質問を
+        完全一致キャッシュで同一視できるようにする
+        """
+        return unicodedata.normalize("NFKC", user_question).strip().lower()
+
+    def _embed_normalized(self, user_question: str) -> np.ndarray:
+        """
+        🆕 質問文の埋め込みを単位ベクトルとして取得
+
+        ChromaManagerのLRUキャッシュ済み埋め込みを使うため、
+        直後の類似度検索と埋め込みAPI呼び出しを共有できる
+        """
+        vec = np.asarray(
+            self.chroma_manager._embed_query_cached(user_question),
+            dtype=np.float32
+        )
+        norm = np.linalg.norm(vec)
+        if norm > 0:
+            vec = vec / norm
+        return vec
+
+    def _resp_cache_lookup(self, user_question: str, norm_q: str) -> Optional[Dict[str, Any]]:
+        """
+        🆕 レスポンスキャッシュを検索(完全一致 → 意味的一致の順)
+
+        Args:
+            user_question: 元の質問文(埋め込み計算に使用)
+            norm_q: _normalize_question()で正規化した質問文
+
+        Returns:
+            キャッシュヒットした場合はget_rag_response_data形式の辞書、
+            ミスの場合はNone
+        """
+        # まず正規化文字列の完全一致(埋め込み計算すら不要)
+        cached = self._resp_cache.get(norm_q)
+        if cached is not None:
+            self._resp_cache.move_to_end(norm_q)
+            return dict(cached[1])
+
+        if not self._resp_cache:
+            return None
+
+        # 意味的一致: キャッシュ全体との類似度を1回の行列積で計算
+        # (ここで計算した埋め込みはLRU経由で直後の検索にも再利用される)
+        q_vec = self._embed_normalized(user_question)
+
+        if self._resp_cache_matrix is None:
+            self._resp_cache_keys = list(self._resp_cache)
+            self._resp_cache_matrix = np.vstack(
+                [self._resp_cache[key][0] for key in self._resp_cache_keys]
+            )
+
+        similarities = self._resp_cache_matrix @ q_vec
+        best = int(np.argmax(similarities))
+
+        if similarities[best] >= _RESP_CACHE_THRESHOLD:
+            key = self._resp_cache_keys[best]
+            self._resp_cache.move_to_end(key)
+            return dict(self._resp_cache[key][1])
+
+        return None
+
+    def _resp_cache_store(
+        self,
+        user_question: str,
+        norm_q: str,
+        rag_data: Dict[str, Any]
+    ):
+        """
+        🆕 レスポンスキャッシュに結果を保存(LRUで上限管理・SQLiteにも永続化)
+        """
+        embedding = self._embed_normalized(user_question)
+        self._resp_cache[norm_q] = (embedding, rag_data)
+        self._resp_cache.move_to_end(norm_q)
+        self._persist_resp_cache_entry(norm_q, embedding, rag_data)
+
+        while len(self._resp_cache) > _RESP_CACHE_SIZE:
+            evicted_key, _ = self._resp_cache.popitem(last=False)
+            if self._resp_db is not None:
+                try:
+                    self._resp_db.execute(
+                        "DELETE FROM response_cache WHERE norm_q = ?",
+                        (evicted_key,)
+                    )
+                except Exception as e:
+                    logger.warning(f"⚠️ レスポンスキャッシュ削除エラー: {e}")
+
+        # 行列は次の意味的検索時に作り直す
+        self._resp_cache_matrix = None
+
+    def _clear_resp_cache(self):
+        """
+        🆕 レスポンスキャッシュを全消去(メモリ+SQLite)
+
+        ドキュメントの入れ替え後は、キャッシュ済みの検索結果や
+        プロンプトが新しいコーパスと食い違うため、永続化分も含めて
+        ここで無効化する
+        """
+        self._resp_cache.clear()
+        self._resp_cache_matrix = None
+        self._resp_cache_keys = []
+
+        if self._resp_db is not None:
+            try:
+                self._resp_db.execute("DELETE FROM response_cache")
+            except Exception as e:
+                logger.warning(f"⚠️ レスポンスキャッシュ全消去エラー: {e}")
+
+        logger.info("🧹 レスポンスキャッシュをクリアしました")
+
     def get_rag_response_data(
         self,
         user_question: str
@@ -279,29 +594,50 @@ class RAGManager:
         else:
             # 通常の質問をAIに送信
         """
+        # 🆕 空文字や記号1文字のような質問は検索せず即リターン
+        if len(user_question.strip()) < _MIN_RAG_QUERY_CHARS:
+            return {
+                "use_rag": False,
+                "context": "",
+                "prompt": "",
+                "search_results": []
+            }
+
+        # 🆕 まずレスポンスキャッシュを確認
+        # (言い換え質問も埋め込み類似度で同一視して検索ごと省略する)
+        norm_q = self._normalize_question(user_question)
+        cached = self._resp_cache_lookup(user_question, norm_q)
+        if cached is not None:
+            return cached
+
         # 検索実行
         results, use_rag = self.query(user_question)
-        
+
         if not use_rag:
-            return {
+            rag_data = {
                 "use_rag": False,
                 "context": "",
                 "prompt": "",
                 "search_results": []
             }
-        
-        # コンテキスト構築
-        context = self.build_rag_context(results)
-        
-        # プロンプト構築
-        prompt = self.build_rag_prompt(user_question, context)
-        
-        return {
-            "use_rag": True,
-            "context": context,
-            "prompt": prompt,
-            "search_results": results
-        }
+        else:
+            # コンテキスト構築
+            context = self.build_rag_context(results)
+
+            # プロンプト構築
+            prompt = self.build_rag_prompt(user_question, context)
+
+            rag_data = {
+                "use_rag": True,
+                "context": context,
+                "prompt": prompt,
+                "search_results": results
+            }
+
+        # 🆕 次回以降の同一/類似質問のためにキャッシュ
+        self._resp_cache_store(user_question, norm_q, rag_data)
+
+        return rag_data
     
     def get_status(self) -> Dict[str, Any]:
         """
@@ -330,10 +666,109 @@ class RAGManager:
         Returns:
             GoogleドライブのURL(なければ空文字列)
         """
-        return GOOGLE_DRIVE_LINKS.get(filename, "")
+        # 登録済みファイルがヒットの大半なので、.get()のデフォルト処理より
+        # try/exceptの方がわずかに速い(描画ループでチャンクごとに呼ばれる)
+        try:
+            return GOOGLE_DRIVE_LINKS[filename]
+        except KeyError:
+            return ""
     
     def reload_documents(self) -> bool:
         """ドキュメントを再読み込み"""
-        print("\n🔄 ドキュメント再読み込み開始...")
+        logger.info("\n🔄 ドキュメント再読み込み開始...")
         self.chroma_manager.clear_collection()
+        # コーパスが変わるので古い検索結果のキャッシュは捨てる
+        self._clear_resp_cache()
         return self.process_all_pdfs()
+
+    @staticmethod
+    def _hash_file(path: Path) -> str:
+        """
+        🆕 ファイルのsha256ハッシュを計算(1MBずつ読みながら)
+        """
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def sync_documents(self) -> bool:
+        """
+        🆕 変更のあったファイルだけを差し替える増分再読み込み
+
+        【処理の流れ】
+        1. 各ファイル(.pdf / .html)のsha256を計算してmanifest.jsonと比較
+        2. 変更なし → スキップ(再埋め込みのAPIコストゼロ)
+        3. 変更あり/新規 → 旧チャンクを削除して再登録
+        4. ディレクトリから消えたファイル → チャンクを削除
+        5. manifestを更新して保存
+
+        全クリア+全再埋め込みのreload_documents()と違い、
+        3ファイル中1ファイルだけ変わった場合は1ファイル分の
+        埋め込みコストしかかからない
+
+        Returns:
+            全ファイルの処理に成功した場合True
+        """
+        manifest_path = Path(self.chroma_manager.persist_directory) / "manifest.json"
+
+        try:
+            manifest = (
+                orjson.loads(manifest_path.read_bytes())
+                if manifest_path.exists() else {}
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ manifest読み込みエラー(全件再登録します): {e}")
+            manifest = {}
+
+        # 現在のドキュメントとそのハッシュを収集
+        # (全件登録パスと同様にPDFとHTMLの両方を対象にする)
+        doc_paths = sorted(
+            path
+            for pattern in ("*.pdf", "*.html")
+            for path in Path(self.documents_dir).glob(pattern)
+        )
+        current = {
+            doc_path.name: (doc_path, self._hash_file(doc_path))
+            for doc_path in doc_paths
+        }
+
+        # ディレクトリから消えたファイルのチャンクを削除
+        removed = set(manifest) - set(current)
+        for filename in removed:
+            logger.info(f"🗑️ 削除されたファイルのチャンクを除去: {filename}")
+            self.chroma_manager.delete_by_source(filename)
+
+        success = True
+        new_manifest = {}
+        changed = 0
+
+        for filename, (doc_path, digest) in current.items():
+            if manifest.get(filename) == digest:
+                logger.info(f"⏭️ 変更なし: {filename}")
+                new_manifest[filename] = digest
+                continue
+
+            # 変更あり/新規: 旧チャンクを消してから入れ直す
+            if filename in manifest:
+                self.chroma_manager.delete_by_source(filename)
+
+            if self._process_and_store_file(str(doc_path)):
+                new_manifest[filename] = digest
+                changed += 1
+            else:
+                success = False
+
+        try:
+            manifest_path.write_bytes(
+                orjson.dumps(new_manifest, option=orjson.OPT_INDENT_2)
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ manifest保存エラー: {e}")
+
+        # コーパスに変化があった場合はキャッシュ済みの検索結果を無効化
+        if removed or changed:
+            self._clear_resp_cache()
+
+        logger.info(f"\n✅ 増分同期完了: 更新 {changed}件 / 全{len(current)}件")
+        return success
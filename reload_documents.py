@@ -1,7 +1,12 @@
 """
 ChromaDBのドキュメントを再読み込みするスクリプト
-ファイル名を変更した後に実行してください
+ファイルを追加・更新・削除した後に実行してください
+
+🆕 sha256のmanifest比較で変更のあったファイルだけを再埋め込みする
+(全件やり直したい場合は --full を付けて実行)
 """
+import sys
+
 from dotenv import load_dotenv
 from chat.rag_manager import RAGManager
 
@@ -18,17 +23,24 @@ rag_manager = RAGManager(
     threshold=1.5
 )
 
-print("\n🔄 既存データをクリア中...")
-success = rag_manager.chroma_manager.clear_collection()
+if "--full" in sys.argv:
+    # 従来どおりの全クリア+全再埋め込み
+    print("\n🔄 既存データをクリア中...")
+    success = rag_manager.chroma_manager.clear_collection()
 
-if not success:
-    print("❌ クリアに失敗しました")
-    exit(1)
+    if not success:
+        print("❌ クリアに失敗しました")
+        exit(1)
 
-print("✅ クリア完了")
+    print("✅ クリア完了")
 
-print("\n📥 新しいドキュメントを読み込み中...")
-success = rag_manager.process_all_pdfs()
+    print("\n📥 新しいドキュメントを読み込み中...")
+    success = rag_manager.process_all_pdfs()
+else:
+    # 🆕 変更のあったファイルだけを差し替える
+    # (未変更ファイルの再埋め込みAPIコストと時間を丸ごと節約)
+    print("\n📥 変更のあったドキュメントを読み込み中...")
+    success = rag_manager.sync_documents()
 
 if success:
     print("\n" + "=" * 50)
@@ -144,17 +144,14 @@ def reset_to_demo():
     print("\n📋 Step 1: 既存チャットを削除中...")
     
     all_chats = db_manager.get_all_chats()
-    delete_count = 0
-    
-    for chat in all_chats:
-        success = db_manager.delete_chat(chat["id"])
-        if success:
-            delete_count += 1
-            print(f"   ✅ 削除: {chat['title']}")
-        else:
-            print(f"   ❌ 削除失敗: {chat['title']}")
-    
-    print(f"\n   合計 {delete_count} 件のチャットを削除しました")
+
+    # 🆕 1件ずつdelete_chatを呼ぶとチャット数ぶんの往復になるため、
+    # メッセージ込みでバッチ削除するbulk_delete_chatsにまとめる
+    delete_count = db_manager.bulk_delete_chats(
+        [chat["id"] for chat in all_chats]
+    )
+
+    print(f"   合計 {delete_count} 件のチャットを削除しました")
     
     # ============================================
     # Step 2: テンプレート会話を作成
@@ -171,7 +168,11 @@ def reset_to_demo():
             print(f"   ✅ 作成: {template['title']}")
         else:
             print(f"   ❌ 作成失敗: {template['title']}")
-    
+
+    # write-behindキューに残っている作成オペレーションを
+    # 確認の前に確実にコミットしておく
+    db_manager.flush_pending_writes()
+
     # ============================================
     # 完了
     # ============================================
@@ -180,10 +181,9 @@ def reset_to_demo():
     print("=" * 50)
     
     # 最終確認
-    final_chats = db_manager.get_all_chats()
-    print(f"\n📊 現在のチャット数: {len(final_chats)} 件")
-    for chat in final_chats:
-        print(f"   - {chat['title']}")
+    # 🆕 全ドキュメントを読み戻さず、サーバー側のcount()集計で件数だけ確認
+    # (作成済みタイトルはStep 2で出力済み)
+    print(f"\n📊 現在のチャット数: {db_manager.get_chat_count()} 件")
     
     print("\n✨ Streamlitを起動してください: streamlit run main.py")
 